@@ -0,0 +1,165 @@
+# This file is part of sealice visualisation tools.
+#
+# This app is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3
+#
+# The app is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details., see
+# <https://www.gnu.org/licenses/>.
+#
+# Copyright 2022, Julien Moreau, Plastic@Bay CIC
+
+import json, logging, hashlib, csv
+import multiprocessing
+from itertools import product
+from concurrent.futures import ProcessPoolExecutor
+from os import path, makedirs
+import numpy as np
+
+from registry import load_registry, years
+from scenario import lice_factors, scenario_coefficients
+from density import load_density_cube, load_masks, weighted_sum, crop_view, apply_mask, cell_moments, moment_stats, reset_dask_pool
+
+logger = logging.getLogger('sealice_logger')
+
+# data of the batch, loaded in the parent before the pool forks
+# so that the workers share the cubes instead of reading them again
+_engine={}
+
+def sweep(years=[2018], biomass=[100], lice=[0.5], egg=[False], planned=[False],
+          measured=[False], existing=[True]):
+    '''
+    Scenarios of all the combinations of the knobs, as set in the app:
+    biomass knob (%), lice knob, egg model (Stein if True),
+    planned farms added, measured lice and existing farms drawn
+    '''
+    return [{'year':year, 'biomass':b, 'lice':l, 'egg':e, 'planned':p, 'measured':m, 'existing':x}
+            for year, b, l, e, p, m, x in product(years, biomass, lice, egg, planned, measured, existing)]
+
+def scenario_name(scenario):
+    '''
+    Content hash of a scenario, used to name its grid
+    '''
+    return hashlib.sha1(json.dumps(scenario, sort_keys=True).encode()).hexdigest()[:20]
+
+def load_engine(rootdir, resolution, in_memory=True):
+    '''
+    Read the registry, the density cubes and the masks of a resolution
+    '''
+    _engine['variables']=load_registry(rootdir)
+    cubes=[load_density_cube(rootdir+f'{prefix}_{resolution}m_cube.zarr') for prefix in ['curr', 'planned']]
+    if in_memory:
+        cubes=[cube.load() for cube in cubes]
+    _engine['cubes']=cubes
+    _engine['masks']=load_masks(rootdir+f'mask_{resolution}m.zarr')
+    _engine['resolution']=resolution
+    _engine['planned names']=[l[1] for l in _engine['variables']['future_farms']]
+    logger.info(f'batch engine loaded at {resolution}m')
+    return _engine
+
+def scenario_grid(scenario, view=None):
+    '''
+    Density grid and coefficients of a scenario, as drawn by the app
+    '''
+    variables=_engine['variables']
+    super_cube, planned_cube = _engine['cubes']
+    if view is not None:
+        super_cube, planned_cube = crop_view(super_cube, view), crop_view(planned_cube, view)
+    lice=lice_factors(len(variables['farms']), scenario['lice'], scenario['egg'], scenario['measured'])
+    dataset=scenario_coefficients(variables, scenario['year'], scenario['biomass'], lice,
+                                  scenario.get('biomass toggle', True), scenario['measured'])
+    masks=_engine['masks']
+    grid=weighted_sum(super_cube, [], [])
+    if scenario['existing']:
+        current=weighted_sum(super_cube, dataset['coeff'], dataset['name list'])
+        grid=grid+apply_mask(current, masks['border'])
+    if scenario['planned']:
+        names=_engine['planned names']
+        grid=grid+weighted_sum(planned_cube, np.full(len(names), dataset['lice/egg factor']), names)
+    return apply_mask(grid, masks['land']), dataset
+
+def run_scenario(scenario, outdir=None, view=None):
+    '''
+    Compute the grid of a scenario and its summary statistics
+    (cell counts, max, mean and std in the units of the app),
+    the grid is written to outdir/<name>.zarr if outdir is given
+    '''
+    # knobs missing from the scenario take the defaults of the app
+    scenario={**sweep()[0], **scenario}
+    grid, dataset = scenario_grid(scenario, view)
+    name=scenario_name(scenario)
+    factor=1000000/(_engine['resolution']**2)
+    count, vmax, mean, std = moment_stats(cell_moments(np.asarray(grid.values).ravel()))
+    if outdir is not None:
+        grid.to_dataset(name='density').to_zarr(path.join(outdir, f'{name}.zarr'), mode='w', consolidated=True)
+    return {'name':name, **scenario,
+            'resolution':_engine['resolution'],
+            'farms':len(dataset['name list']),
+            'all lice':float(dataset['all lice']),
+            'counts':count,
+            'max':vmax*factor,
+            'mean':mean*factor,
+            'stdv':std*factor}
+
+def run_batch(scenarios, outdir=None, view=None, workers=None):
+    '''
+    Run the scenarios over a pool of forked processes sharing the loaded engine
+    '''
+    if outdir is not None:
+        makedirs(outdir, exist_ok=True)
+    context=multiprocessing.get_context('fork')
+    results=[]
+    # the engine was read through dask in the parent, whose thread pool does not survive the fork
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=reset_dask_pool) as pool:
+        for result in pool.map(run_scenario, scenarios, [outdir]*len(scenarios), [view]*len(scenarios)):
+            logger.info(f"scenario {result['name']} done")
+            results.append(result)
+    return results
+
+def write_summary(results, filename):
+    with open(filename, 'w', newline='') as f:
+        writer=csv.DictWriter(f, fieldnames=list(results[0].keys()))
+        writer.writeheader()
+        writer.writerows(results)
+
+def on_off(value):
+    return {'on':[True], 'off':[False], 'both':[False, True]}[value]
+
+if __name__ == '__main__':
+    import argparse
+    logging.basicConfig(format='%(levelname)s:%(asctime)s__%(message)s', datefmt='%m/%d/%Y %I:%M:%S')
+    parser=argparse.ArgumentParser(description='Density maps and statistics of scenario sweeps')
+    parser.add_argument('rootdir', help='data directory of the app')
+    parser.add_argument('outdir', help='directory of the grids and of summary.csv')
+    parser.add_argument('--scenarios', default=None,
+                        help='json list of scenarios instead of the sweep of the options below')
+    parser.add_argument('--years', type=int, nargs='+', default=list(years))
+    parser.add_argument('--biomass', type=float, nargs='+', default=[100], help='biomass knob (%%)')
+    parser.add_argument('--lice', type=float, nargs='+', default=[0.5], help='lice knob')
+    parser.add_argument('--egg', choices=['on','off','both'], default='off', help='Stein egg model')
+    parser.add_argument('--planned', choices=['on','off','both'], default='off', help='add the planned farms')
+    parser.add_argument('--measured', choices=['on','off','both'], default='off', help='measured lice')
+    parser.add_argument('--resolution', type=int, default=800)
+    parser.add_argument('--view', type=float, nargs=4, default=None,
+                        metavar=('XMIN','XMAX','YMIN','YMAX'), help='EPSG:3857 extent of the grids')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--no-grids', action='store_true', help='only write the statistics')
+    args=parser.parse_args()
+    logger.setLevel(logging.INFO)
+    if args.scenarios is not None:
+        with open(args.scenarios) as f:
+            scenarios=json.load(f)
+    else:
+        scenarios=sweep(args.years, args.biomass, args.lice, on_off(args.egg),
+                        on_off(args.planned), on_off(args.measured))
+    view=None
+    if args.view is not None:
+        view=dict(zip(['xmin','xmax','ymin','ymax'], args.view))
+    load_engine(args.rootdir, args.resolution)
+    logger.info(f'running {len(scenarios)} scenarios')
+    results=run_batch(scenarios, None if args.no_grids else args.outdir, view, args.workers)
+    makedirs(args.outdir, exist_ok=True)
+    write_summary(results, path.join(args.outdir, 'summary.csv'))
@@ -0,0 +1,136 @@
+# This file is part of sealice visualisation tools.
+#
+# This app is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3
+#
+# The app is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details., see
+# <https://www.gnu.org/licenses/>.
+#
+# Copyright 2022, Julien Moreau, Plastic@Bay CIC
+
+import json, logging, base64
+from datetime import datetime, date
+import numpy as np
+import orjson
+
+logger = logging.getLogger('sealice_logger')
+
+class JsonEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, np.ndarray):
+            return obj.tolist()
+        elif isinstance(obj, np.generic):
+            return obj.item()
+        elif isinstance(obj, (datetime, date)):
+            return (str(obj))
+        else:
+            return json.JSONEncoder.default(self, obj)
+
+def _orjson_default(obj):
+    # arrays orjson cannot serialise natively (strings, objects, non contiguous)
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError
+
+orjson_options=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NAIVE_UTC
+
+def pack_arrays(obj):
+    '''
+    Replace the numeric arrays by base64 buffers with a dtype and shape header
+    '''
+    if isinstance(obj, np.ndarray) and obj.dtype.kind in 'biufcUM':
+        return {'__ndarray__':base64.b64encode(np.ascontiguousarray(obj).tobytes()).decode(),
+                'dtype':obj.dtype.str,
+                'shape':obj.shape}
+    if isinstance(obj, dict):
+        return {key:pack_arrays(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [pack_arrays(value) for value in obj]
+    return obj
+
+def unpack_arrays(obj):
+    '''
+    Restore the arrays packed by pack_arrays
+    '''
+    if isinstance(obj, dict):
+        if '__ndarray__' in obj:
+            arr=np.frombuffer(base64.b64decode(obj['__ndarray__']),
+                              dtype=obj['dtype']).reshape(obj['shape'])
+            # strings come back as python lists, as with json, they are used as dict keys
+            return arr.tolist() if arr.dtype.kind=='U' else arr
+        return {key:unpack_arrays(value) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [unpack_arrays(value) for value in obj]
+    return obj
+
+codecs={
+    # historical encoding, arrays become lists
+    'json':lambda obj: json.dumps(obj, cls=JsonEncoder),
+    # arrays serialised natively by orjson, NaN become null
+    'orjson':lambda obj: orjson.dumps(obj, default=_orjson_default, option=orjson_options).decode(),
+    # arrays as base64 typed buffers, decoded back to arrays
+    'packed':lambda obj: orjson.dumps(pack_arrays(obj), default=_orjson_default, option=orjson_options).decode(),
+    }
+
+def dumps_store(obj, codec='orjson'):
+    '''
+    Serialise the content of a dcc.Store with the chosen codec
+    '''
+    return codecs[codec](obj)
+
+def loads_store(data):
+    '''
+    Deserialise the content of a dcc.Store written by any of the codecs
+    '''
+    try:
+        obj=orjson.loads(data)
+    except orjson.JSONDecodeError:
+        # NaN written by the json codec
+        obj=json.loads(data)
+    return unpack_arrays(obj)
+
+def benchmark(payload, repeat=5):
+    '''
+    Time the encoding and decoding of the payload with each codec
+    '''
+    import timeit
+    results={}
+    for name in codecs:
+        encoded=dumps_store(payload, name)
+        results[name]={'size (kB)':len(encoded)/1024,
+                       'dumps (ms)':min(timeit.repeat(lambda: dumps_store(payload, name), number=1, repeat=repeat))*1000,
+                       'loads (ms)':min(timeit.repeat(lambda: loads_store(encoded), number=1, repeat=repeat))*1000}
+    return results
+
+def init_payload(variables):
+    '''
+    Rebuild the payload that the init store used to carry from the registry
+    '''
+    farms=variables['farms']
+    farm_data={}
+    for i, farm in enumerate(farms['name']):
+        farm_data[str(farm)]={field:farms[field][i].item() for field in farms.dtype.names}
+        farm_data[str(farm)]['biomasses']=variables['biomass'][i]
+        farm_data[str(farm)]['lice data']=variables['lice'][i]
+    return {'All_names':variables['All_names'],
+            'future_farms':variables['future_farms'].tolist(),
+            'lice time':variables['lice time'],
+            'times':variables['times'],
+            'farm_data':farm_data}
+
+if __name__ == '__main__':
+    import sys
+    from registry import load_registry
+    logging.basicConfig(format='%(levelname)s:%(asctime)s__%(message)s', datefmt='%m/%d/%Y %I:%M:%S')
+    if len(sys.argv)<2:
+        sys.exit('usage: python codec.py <data directory>')
+    payload=init_payload(load_registry(sys.argv[1]))
+    print(f"{'codec':<8}{'size (kB)':>12}{'dumps (ms)':>12}{'loads (ms)':>12}")
+    for name, result in benchmark(payload).items():
+        print(f"{name:<8}{result['size (kB)']:>12.1f}{result['dumps (ms)']:>12.2f}{result['loads (ms)']:>12.2f}")
@@ -0,0 +1,361 @@
+# This file is part of sealice visualisation tools.
+#
+# This app is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3
+#
+# The app is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details., see
+# <https://www.gnu.org/licenses/>.
+#
+# Copyright 2022, Julien Moreau, Plastic@Bay CIC
+
+import logging, json
+import numpy as np
+import xarray as xr
+import dask.array as da
+import dask.threaded
+from rasterio.features import geometry_mask
+from rasterio.warp import transform_geom
+from affine import Affine
+
+logger = logging.getLogger('sealice_logger')
+
+def reset_dask_pool():
+    '''
+    Drop the dask thread pool inherited by a forked process (gunicorn or celery
+    worker), its threads do not survive the fork and a compute would wait forever
+    '''
+    dask.threaded.default_pool=None
+    dask.threaded.pools.clear()
+
+def load_density_cube(path, names=None):
+    '''
+    Open a (farm, y, x) density cube built by build_density_cube.
+    If names is given the farm axis is reordered to match it (farm_data IDs).
+    '''
+    cube=xr.open_zarr(path)['density']
+    if names is not None and list(cube.farm.values) != list(names):
+        logger.info(f'reordering the farm axis of {path}')
+        cube=cube.sel(farm=[farm for farm in names if farm in cube.indexes['farm']])
+    return cube
+
+def load_memmap_cube(path):
+    '''
+    Map a (farm, y, x) float32 .npy cube built by build_memmap_cube,
+    the coordinates are read from the json sidecar next to it.
+    Nothing is read until a farm is used and the pages are shared
+    between the processes through the page cache.
+    '''
+    with open(path[:-len('.npy')]+'.json') as f:
+        sidecar=json.load(f)
+    data=np.load(path, mmap_mode='r')
+    return xr.DataArray(data, dims=('farm','y','x'),
+                        coords={'farm':sidecar['farm'],
+                                'y':np.array(sidecar['y']),
+                                'x':np.array(sidecar['x']),
+                                'ID':('farm', np.arange(len(sidecar['farm'])))},
+                        name='density')
+
+def farm_weights(cube, coeff, names):
+    '''
+    Expand the coefficients of the listed farms into a vector along the
+    farm axis of the cube, farms not listed get 0
+    '''
+    weights=np.zeros(cube.sizes['farm'], dtype='float32')
+    pos=cube.indexes['farm'].get_indexer(list(names))
+    found=pos>=0
+    if not found.all():
+        logger.debug(f'{(~found).sum()} farms are not in the cube')
+    weights[pos[found]]=np.asarray(coeff, dtype='float32')[found]
+    return weights
+
+def _tensordot_block(block, weights):
+    return np.tensordot(weights, block, axes=1).astype('float32')
+
+def weighted_sum(cube, coeff, names, farm_chunk=32):
+    '''
+    Sum the contributions of the listed farms scaled by coeff
+    in one reduction over the farm axis (coeff @ cube).
+    Only the farms with a non-zero coefficient are read, a dask cube stays lazy
+    and is reduced tile by tile, an in-memory cube is accumulated farm_chunk
+    farms at a time. The cube is never written to.
+    '''
+    weights=farm_weights(cube, coeff, names)
+    active=np.nonzero(weights)[0]
+    coords={'y':cube.y.values, 'x':cube.x.values}
+    if len(active)==0:
+        return xr.DataArray(np.zeros((cube.sizes['y'], cube.sizes['x']), dtype='float32'),
+                            dims=('y','x'), coords=coords)
+    data=cube.transpose('farm','y','x').data
+    if isinstance(data, da.Array):
+        grid=da.blockwise(_tensordot_block, 'yx', data[active], 'fyx',
+                          concatenate=True, weights=weights[active], dtype='float32')
+    else:
+        grid=np.zeros(data.shape[1:], dtype='float32')
+        for start in range(0, len(active), farm_chunk):
+            group=active[start:start+farm_chunk]
+            grid+=np.tensordot(weights[group], data[group], axes=1)
+    return xr.DataArray(grid, dims=('y','x'), coords=coords)
+
+def load_lowrank(path):
+    '''
+    Open a low-rank basis built by build_lowrank, U is loaded in memory
+    '''
+    lowrank=xr.open_zarr(path)
+    return lowrank.assign(U=lowrank['U'].compute())
+
+def lowrank_sum(lowrank, coeff, names):
+    '''
+    Sum of the listed farms scaled by coeff from the low-rank basis,
+    (coeff @ U) @ V, the cube is not read. The sum is linear in coeff,
+    the ringing of the truncated basis below 0 is left to the caller.
+    '''
+    mix=farm_weights(lowrank, coeff, names)@lowrank['U'].values
+    grid=np.tensordot(mix.astype('float32'), np.asarray(lowrank['V'].values), axes=1)
+    return xr.DataArray(grid, dims=('y','x'),
+                        coords={'y':lowrank.y.values, 'x':lowrank.x.values})
+
+def load_footprints(path, in_memory=False):
+    '''
+    Open a footprint store built by build_footprints.
+    The tile index is loaded, the values are only loaded if in_memory.
+    '''
+    fp=xr.open_zarr(path)
+    fp=fp.assign(bbox=fp['bbox'].compute(), offset=fp['offset'].compute())
+    if in_memory:
+        fp=fp.assign(values=fp['values'].compute())
+    return fp
+
+def coord_slice(coord, low, high):
+    '''
+    Slice of the monotonic coordinate (ascending or descending)
+    strictly between low and high
+    '''
+    n=len(coord)
+    if n<2 or coord[0]<=coord[-1]:
+        start, stop = np.searchsorted(coord, low, side='right'), np.searchsorted(coord, high, side='left')
+    else:
+        rev=coord[::-1]
+        start, stop = n-np.searchsorted(rev, high, side='left'), n-np.searchsorted(rev, low, side='right')
+    return slice(int(start), int(max(start, stop)))
+
+def view_slices(ds, viewdata):
+    '''
+    Integer slices along y and x of the cells inside the viewport corners
+    '''
+    return coord_slice(ds.y.values, viewdata['ymin'], viewdata['ymax']), \
+           coord_slice(ds.x.values, viewdata['xmin'], viewdata['xmax'])
+
+def crop_view(ds, viewdata):
+    '''
+    Crop a dataset or array to the viewport by index,
+    the cost only depends on the visible area
+    '''
+    ys, xs = view_slices(ds, viewdata)
+    return ds.isel(y=ys, x=xs)
+
+def quantise_view(viewdata, step):
+    '''
+    Expand the viewport corners outward to multiples of step
+    so that close viewports share the same render
+    '''
+    quantised=dict(viewdata)
+    quantised['xmin']=float(np.floor(viewdata['xmin']/step)*step)
+    quantised['ymin']=float(np.floor(viewdata['ymin']/step)*step)
+    quantised['xmax']=float(np.ceil(viewdata['xmax']/step)*step)
+    quantised['ymax']=float(np.ceil(viewdata['ymax']/step)*step)
+    return quantised
+
+def view_window(ds, viewdata):
+    '''
+    Index window (y0, y1, x0, x1) of the grid cells inside the viewport
+    '''
+    ys, xs = view_slices(ds, viewdata)
+    return ys.start, ys.stop, xs.start, xs.stop
+
+def footprint_tile(fp, i):
+    '''
+    Bounding-box tile of the farm at position i of the footprint store
+    '''
+    y0, y1, x0, x1 = fp['bbox'].values[i]
+    start=fp['offset'].values[i]
+    return np.asarray(fp['values'][start:start+(y1-y0)*(x1-x0)].values).reshape(y1-y0, x1-x0)
+
+def accumulate_footprints(fp, coeff, names, window=None):
+    '''
+    Sum the footprints of the listed farms scaled by coeff on the
+    index window (y0, y1, x0, x1), only the cells covered by each farm are touched
+    '''
+    if window is None:
+        window=(0, fp.sizes['y'], 0, fp.sizes['x'])
+    y0, y1, x0, x1 = window
+    grid=np.zeros((y1-y0, x1-x0), dtype='float32')
+    weights=farm_weights(fp, coeff, names)
+    bbox=fp['bbox'].values
+    for i in np.nonzero(weights)[0]:
+        fy0, fy1, fx0, fx1 = bbox[i]
+        iy0, iy1, ix0, ix1 = max(fy0, y0), min(fy1, y1), max(fx0, x0), min(fx1, x1)
+        if iy0>=iy1 or ix0>=ix1:
+            continue
+        tile=footprint_tile(fp, i)
+        grid[iy0-y0:iy1-y0, ix0-x0:ix1-x0]+=weights[i]*tile[iy0-fy0:iy1-fy0, ix0-fx0:ix1-fx0]
+    return xr.DataArray(grid, dims=('y','x'),
+                        coords={'y':fp.y.values[y0:y1], 'x':fp.x.values[x0:x1]})
+
+def selection_cells(grid, selection):
+    '''
+    Rasterise the selection polygons (lon, lat) on the y, x grid.
+    Returns the index window (y0, y1, x0, x1) around the polygons
+    and the flat indices within the window of the cells inside them
+    '''
+    geoms=[transform_geom('EPSG:4326', 'EPSG:3857', geom) for geom in selection]
+    corners=np.vstack([np.asarray(ring)[:, :2] for geom in geoms for ring in geom['coordinates']])
+    ys, xs = view_slices(grid, {'xmin':corners[:,0].min(), 'xmax':corners[:,0].max(),
+                                'ymin':corners[:,1].min(), 'ymax':corners[:,1].max()})
+    window=(ys.start, ys.stop, xs.start, xs.stop)
+    if ys.stop-ys.start<1 or xs.stop-xs.start<1:
+        return window, np.zeros(0, dtype='int64')
+    x, y = grid.x.values, grid.y.values
+    dx=float(x[1]-x[0]) if len(x)>1 else 1.
+    dy=float(y[1]-y[0]) if len(y)>1 else -1.
+    transform=Affine(dx, 0., float(x[xs.start])-dx/2, 0., dy, float(y[ys.start])-dy/2)
+    inside=geometry_mask(geoms, out_shape=(ys.stop-ys.start, xs.stop-xs.start),
+                         transform=transform, invert=True)
+    return window, np.flatnonzero(inside)
+
+def cell_positions(cells):
+    '''
+    Row and column on the grid of the selected cells
+    '''
+    (y0, y1, x0, x1), flat = cells
+    return y0+flat//(x1-x0), x0+flat%(x1-x0)
+
+def mask_cells(cells, mask):
+    '''
+    Keep the selected cells where the (y, x) mask is True
+    '''
+    window, flat = cells
+    rows, cols = cell_positions(cells)
+    return window, flat[np.asarray(mask.values)[rows, cols]]
+
+def cell_moments(values):
+    '''
+    count, max, sum and sum of squares of the positive values along the last axis.
+    The stores keep the empty cells as 0, so the cells of a farm field that are
+    exactly 0 are left out of the count, mean and std, where the NaN count of the
+    per-farm zarrs included them
+    '''
+    valid=values>0
+    kept=np.where(valid, values, 0).astype('float64')
+    return np.stack([valid.sum(axis=-1), kept.max(axis=-1, initial=0),
+                     kept.sum(axis=-1), (kept**2).sum(axis=-1)], axis=-1)
+
+def scale_moments(moments, factor):
+    '''
+    Moments of the values multiplied by factor
+    '''
+    return moments*np.array([1, factor, factor, factor**2])
+
+def combine_moments(moments):
+    '''
+    Moments of the union of the samples of each row
+    '''
+    moments=np.asarray(moments, dtype='float64').reshape(-1, 4)
+    return np.array([moments[:,0].sum(), moments[:,1].max(initial=0),
+                     moments[:,2].sum(), moments[:,3].sum()])
+
+def moment_stats(moments):
+    '''
+    count, max, mean and (population) standard deviation from the moments
+    '''
+    count, vmax, total, squares = moments
+    if count==0:
+        return 0, float(vmax), np.nan, np.nan
+    mean=total/count
+    return int(count), float(vmax), float(mean), float(np.sqrt(max(squares/count-mean**2, 0)))
+
+def cube_moments(cube, coeff, names, cells, farm_chunk=32):
+    '''
+    Moments of the scaled values of the listed farms on the selected cells
+    in one pass, the window of the selection is read farm_chunk farms at a time
+    '''
+    (y0, y1, x0, x1), flat = cells
+    ids=cube.indexes['farm'].get_indexer(names)
+    coeff=np.asarray(coeff, dtype='float64')
+    keep=np.nonzero((ids>=0)&(coeff!=0))[0]
+    moments={}
+    block=cube.isel(y=slice(y0, y1), x=slice(x0, x1))
+    for start in range(0, len(keep), farm_chunk):
+        part=keep[start:start+farm_chunk]
+        values=np.asarray(block.isel(farm=ids[part]).values).reshape(len(part), -1)[:, flat]
+        for i, m in zip(part, cell_moments(values*coeff[part, None])):
+            moments[names[i]]=m
+    return moments
+
+def footprint_moments(fp, coeff, names, cells):
+    '''
+    Moments of the scaled values of the listed farms on the selected cells,
+    only the farms whose footprint meets the selection are read
+    '''
+    (y0, y1, x0, x1), flat = cells
+    rows, cols = cell_positions(cells)
+    bbox=fp['bbox'].values
+    moments={}
+    for farm, c in zip(names, coeff):
+        if farm not in fp.indexes['farm'] or c==0:
+            continue
+        i=fp.indexes['farm'].get_loc(farm)
+        fy0, fy1, fx0, fx1 = bbox[i]
+        if fy0>=y1 or fy1<=y0 or fx0>=x1 or fx1<=x0:
+            logger.debug(f'{farm} is outside of the selection')
+            continue
+        inbox=(rows>=fy0)&(rows<fy1)&(cols>=fx0)&(cols<fx1)
+        moments[farm]=cell_moments(footprint_tile(fp, i)[rows[inbox]-fy0, cols[inbox]-fx0]*c)
+    return moments
+
+def tile_bounds(z, x, y):
+    '''
+    Corners in EPSG:3857 of the XYZ (slippy map) tile x, y at zoom z
+    '''
+    origin=20037508.342789244
+    size=2*origin/2**z
+    return {'xmin':-origin+x*size,
+            'xmax':-origin+(x+1)*size,
+            'ymin':origin-(y+1)*size,
+            'ymax':origin-y*size}
+
+def select_level(viewdata, resolutions, width=1024, height=512):
+    '''
+    Coarsest resolution (m) of the pyramid that still gives about one cell
+    per screen pixel for the viewport drawn on width x height pixels
+    '''
+    pixel=min((viewdata['xmax']-viewdata['xmin'])/width,
+              (viewdata['ymax']-viewdata['ymin'])/height)
+    finer=[r for r in resolutions if r<=pixel]
+    if len(finer)==0:
+        return min(resolutions)
+    return max(finer)
+
+def cap_pixels(arr, max_pixels=None):
+    '''
+    Average blocks of cells so that the grid holds at most max_pixels cells
+    '''
+    if max_pixels is None or arr.sizes['x']*arr.sizes['y']<=max_pixels:
+        return arr
+    factor=int(np.ceil(np.sqrt(arr.sizes['x']*arr.sizes['y']/max_pixels)))
+    return arr.coarsen(x=factor, y=factor, boundary='trim').mean()
+
+def load_masks(path):
+    '''
+    Land and border masks of a level, small enough to be held in memory
+    '''
+    return xr.open_zarr(path).load()
+
+def apply_mask(arr, mask):
+    '''
+    Zero the cells of the grid outside of the mask
+    '''
+    return arr.where(mask.sel(y=arr.y, x=arr.x), 0)
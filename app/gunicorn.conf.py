@@ -0,0 +1,19 @@
+# gunicorn settings, read from the working directory
+import gc
+from os import environ
+
+bind='0.0.0.0:8050'
+workers=int(environ.get('WEB_CONCURRENCY', 4))
+# import the app once in the master: the registry and the preloaded
+# density levels are shared copy-on-write by the forked workers
+preload_app=True
+
+def pre_fork(server, worker):
+    # keep the preloaded objects out of the garbage collector
+    # so that collections in the workers do not copy their pages
+    gc.freeze()
+
+def post_fork(server, worker):
+    # the import in the master ran dask computes, start a new thread pool
+    from density import reset_dask_pool
+    reset_dask_pool()
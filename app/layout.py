@@ -387,7 +387,7 @@ def tab1_layout():
                         ),
                     dcc.Loading(
                         id='figure_loading',
-                        children=[html.Div(id='heatmap_output'),],
+                        children=[html.Div(id='heatmap_output'), html.Div(id='heatmap_progress')],
                         type='graph',
                         fullscreen=True
                         ),
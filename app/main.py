@@ -14,10 +14,9 @@
 
 
 # import gcsfs
-from  xarray import open_zarr, DataArray
 #from rasterio.enums import Resampling
 import rioxarray
-import json, logging, orjson
+import json, logging, orjson, hashlib
 #from google.cloud import storage
 import numpy as np
 
@@ -28,8 +27,11 @@ import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 from colorcet import fire, bmy
 from datashader import transfer_functions as tf
-from datetime import datetime, timedelta
+from PIL import Image
 from os import path, environ, walk
+import io, base64
+from functools import wraps, lru_cache
+from collections import OrderedDict
 import dash
 from dash import dcc as dcc
 from dash.exceptions import PreventUpdate
@@ -44,21 +46,19 @@ from dash_bootstrap_templates import ThemeSwitchAIO, load_figure_template
 import dash_daq as daq
 
 from flask_caching import Cache
+from flask import Response, abort, jsonify
+from redis import Redis
 # from dash.exceptions import PreventUpdate
 from celery import Celery
+from celery.signals import worker_process_init
 
 from layout import *
 from preprocess import *
-
-class JsonEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, np.ndarray):
-            return obj.tolist()
-        elif isinstance(obj, datetime):
-            return (str(obj))
-        else:
-            return json.JSONEncoder.default(self, obj)
-            
+from density import *
+from render_cache import RenderCache
+from registry import load_registry, farm_record
+from scenario import lice_factors, scenario_coefficients
+from codec import JsonEncoder, dumps_store, loads_store
 
 class DashLoggerHandler(logging.StreamHandler):
     def __init__(self):
@@ -78,13 +78,6 @@ def get_coordinates(arr):
     coordinates[3]=p(arr.x.values[0],arr.y.values[-1], inverse=True)
     return coordinates[::-1]
 
-def crop_ds(ds, viewdata):
-    return ds.where((ds.x<viewdata['xmax'] ) &
-                           (ds.x>viewdata['xmin'] ) &
-                           (ds.y>viewdata['ymin'] ) &
-                           (ds.y<viewdata['ymax'] ), drop=True)
-                           
-    
 def calculate_edge(coordinates):
     #'mapbox._derived': 
     #{'coordinates': 
@@ -103,116 +96,127 @@ def calculate_edge(coordinates):
              }
     return corners
 
-def mk_img(ds, span, cmp):
+def mk_img(arr, span, cmp):
     '''
     Create an image to project on mabpox
+    from the summed density grid
     '''
     logger.info('making raster...')  
-    arr= ds.to_stacked_array('v', ['y', 'x']).sum(dim='v')
-    logger.info('data stacked')
-    polyg= [{"type":"Polygon",
-              "coordinates":[[
-                [-890556, 7719350],
-                [-829330, 7618370],
-                [-857160, 7588335],
-                [-912820, 7688916],
-                [-890556, 7719350]
-              ]]
-            }]
-    arr= arr.rio.write_crs(3857, inplace=True).rio.clip(polyg, invert=True, crs=3857)
-    logger.info('data cropped')
     temp= tf.shade(arr.where(arr>0), cmap=cmp, how='linear', span=span).to_pil()
     return temp
 
-def select_zoom(zoom):
+def mk_tile(arr, bounds, span, cmp, size=256):
+    '''
+    Resample the density grid on a size x size tile
+    and shade it as png bytes
+    '''
+    canvas=DS.Canvas(plot_width=size, plot_height=size,
+                     x_range=(bounds['xmin'], bounds['xmax']),
+                     y_range=(bounds['ymin'], bounds['ymax']))
+    tile=canvas.raster(arr.compute(), agg='mean')
+    img=tf.shade(tile.where(tile>0), cmap=cmp, how='linear', span=span).to_pil()
+    return png_bytes(img)
+
+def scenario_key(scenario):
+    '''
+    Content hash of the scenario parameters
+    '''
+    return hashlib.sha1(json.dumps(scenario, sort_keys=True, cls=JsonEncoder).encode()).hexdigest()[:20]
+
+def view_level(viewdata):
     '''
-    select the zarr resolution according to the zoom for preselection 
-    trying to match https://docs.mapbox.com/help/glossary/zoom-level/
+    Resolution of the pyramid giving about one cell per pixel of the figure
     '''
-    if zoom <6:
-        r=800
-    elif zoom>=9.1:
-        r= 50
-    elif 6<=zoom<7.1:
-        r=400
-    elif 7.1<=zoom<8.1:
-        r=200
-    elif 8.1<zoom<=9.1:
-        r=100
-    return r
+    return select_level(viewdata, resolution, *figure_size)
 
 def query_tree():
    seek= tree.query(np.array([farm_data[farm]['lon'], farm_data[farm]['lat']]).T, n)[1]
    for i in range(n):
-                    remote_data= search_lice_data(start,end, Ids[i], farm, lice_data, farm_data)
+                    remote_data= search_lice_data(start,end, Ids[i], lice_index)
                     if remote_data is not None :
                         return remote_data
                         
     
-def fetch_biomass(farm_data, lice_data, activated_farms, biomass_factor, lice_factor, times, ref_biom, Ids, lice_time, flag, year=2018):
+def tile_layer(key):
     '''
-    Identify the biomass data for the month of may of the chosen year
-    scale the data according to data
-    remove farm with no data for the month
-    if flag is true (toggle is on) try to populate the lice density for each farm
+    Mapbox layer pointing to the tile server for the scenario
     '''
-    n= 50 #nb of nearest farms
-    start, end = np.datetime64(datetime(year=year, month=4,day=30),'D'), np.datetime64(datetime(year=year, month=6,day=1),'D')
-    filters=np.where(np.logical_and(times> start, times< end))[0]
-    filtered=times[filters]
-    for farm in farm_data.keys():       
-        extract=np.array(farm_data[farm]['biomasses'])[filters]
-        extract=np.nanmean(extract[extract!=0])
-        if np.isnan(extract):
-            activated_farms[farm_data[farm]['ID']]= False
-        else:
-            biomass_factor[farm_data[farm]['ID']]=extract/farm_data[farm]['max biomass']
-            ref_biom[farm_data[farm]['ID']]=farm_data[farm]['max biomass']
-            if flag:
-                ident=farm_data[farm]['Site ID Scot env']
-                if len(ident)>0:
-                    local_data=search_lice_data(start,end, ident, 
-                                            farm, lice_data['data_vars'][ident]['data'], 
-                                            farm_data[farm], lice_time)
-                    if local_data is not None :
-                        lice_factor[farm_data[farm]['ID']]=local_data
-                    else:
-                       logger.debug(f'No lice data for farm {farm} during May {year}')
-                       lice_factor[farm_data[farm]['ID']]=0.5                   
-                else:
-                    logger.debug(f'No ID for farm {farm}')
-                    lice_factor[farm_data[farm]['ID']]=0.5
-                
-    return activated_farms, biomass_factor, lice_factor, ref_biom      
+    return [{"below": 'traces',
+             "sourcetype": "raster",
+             "source": [tile_base_url+f'tiles/{key}/{{z}}/{{x}}/{{y}}.png'],
+            }]
+
+def png_bytes(img):
+    buffer=io.BytesIO()
+    img.save(buffer, format='png')
+    return buffer.getvalue()
+
+def mk_scenario(dataset, plan, span, theme):
+    '''
+    Parameters defining a density map, hashed to address the caches
+    '''
+    return {'coeff':dataset['coeff'],
+            'unit coeff':dataset['unit coeff'],
+            'global factor':dataset['global factor'],
+            'name list':dataset['name list'],
+            'lice/egg factor':dataset['lice/egg factor'],
+            'plan':plan,
+            'span':span,
+            'cmp':theme['cmp']}
+
+def cached_render(r, viewdata, scenario):
+    '''
+    Return the png and corner coordinates of the scenario on the viewport,
+    from the render cache if an identical render was already made
+    '''
+    viewdata=quantise_view(viewdata, 16*r)
+    key=scenario_key({**scenario, 'resolution':r, 'max pixels':max_render_pixels,
+                      'view':[viewdata[c] for c in ['xmin','xmax','ymin','ymax']]})
+    cached=render_cache.get(key)
+    if cached is not None:
+        logger.info(f'render {key} found in cache')
+        return cached
+    lock=render_cache.lock(key)
+    owned=lock.acquire()
+    try:
+        # an identical job may have rendered it while we waited
+        cached=render_cache.get(key, count=False)
+        if cached is not None:
+            logger.info(f'render {key} made by another job')
+            return cached
+        arr=density_grid(r, viewdata, scenario, scenario['plan'])
+        if arr is not None:
+            arr=cap_pixels(arr, max_render_pixels)
+        png, coordinates = png_bytes(mk_img(arr, scenario['span'], scenario['cmp'])), get_coordinates(arr).tolist()
+        render_cache.set(key, png, coordinates)
+    finally:
+        if owned:
+            lock.release()
+    return png, coordinates
 
-def render(fig, ds, span, theme, name_list):
+def render(fig, png, coordinates, name_list):
      logger.info('Rendering')
-     coordinates=get_coordinates(ds)
      logger.debug(f'Selected farms for the map:   {name_list}')
      logger.debug(f'coordinates:     {coordinates}')
      fig['layout']['mapbox']['layers']=[{
                                         "below": 'traces',
                                         "sourcetype": "image",
-                                        "source": mk_img(ds, span, theme['cmp']),
+                                        "source": 'data:image/png;base64,'+base64.b64encode(png).decode(),
                                         "coordinates": coordinates
                                     },]
      logger.info('raster loaded')
      return fig
 
-def xr_opening(path):
-    try:
-        logger.info(f'{path} is valid')
-        return open_zarr(path)
-    except:
-        logger.error(f'could not open {path}')
-        return Dataset() #dummy
-        
 def walk(directory):
     paths={}
     for (root,dirs,files) in os.walk(directory):
         paths[root]=[dirs, files]
     return paths
     
+def as_float(x):
+    # NaN are stored as null by the orjson codecs
+    return np.nan if x is None else float(x)
+
 def Mktab(stats):
    data=[]
    var0=None
@@ -232,7 +236,8 @@ def Mktab(stats):
 ############# VARIABLES ##########################33
  # value extent
 resolution=[50,100,200,400,800]
-zooms=[9,8,7,6,5]
+# pixel size of the heatmap figure
+figure_size=(1024, 512)
 # start, end = "2018-05-01", "2018-05-31"
 marks_biomass={
         0.1:'10%',
@@ -305,20 +310,79 @@ dbc_css = (
 cacheconfig={'CACHE_TYPE': 'RedisCache',
              'CACHE_REDIS_HOST': environ['REDIS_URL']
     }
-#celery_app = Celery(__name__, broker=environ['REDIS_URL'], backend=environ['REDIS_URL'])
-#background_callback_manager = dash.CeleryManager(celery_app)
+# the heavy callbacks run on celery workers with BACKGROUND_CALLBACKS=1
+# started with: celery -A main:celery_app worker
+# CELERY_BROKER_URL=memory:// and CELERY_ALWAYS_EAGER=1 run them in process for tests
+use_background=environ.get('BACKGROUND_CALLBACKS', '0')=='1'
+celery_broker=environ.get('CELERY_BROKER_URL', f"redis://{environ['REDIS_URL']}")
+celery_backend=environ.get('CELERY_RESULT_BACKEND',
+                           'cache+memory://' if celery_broker.startswith('memory') else celery_broker)
+celery_app = Celery(__name__, broker=celery_broker, backend=celery_backend)
+celery_app.conf.task_always_eager=environ.get('CELERY_ALWAYS_EAGER', '0')=='1'
+background_callback_manager = dash.CeleryManager(celery_app) if use_background else None
+
+@worker_process_init.connect
+def reset_worker_dask(**kwargs):
+    # the prefork children inherit the dask thread pool of the parent, which
+    # loaded the registry through dask, and would hang on their first compute
+    reset_dask_pool()
 
 ######### APP DEFINITION ############
 #my_backend = FileSystemStore(cache_dir="/tmp")
 app = Dash(__name__,
                 external_stylesheets=[url_theme1],#, dbc_css
                 meta_tags=[{"name": "viewport", "content": "width=device-width, initial-scale=1, maximum-scale=1.2, minimum-scale=0.5"}],
+                background_callback_manager=background_callback_manager,
                 #transforms=[] #LogTransform(), ServersideOutputTransform(backend=my_backend)
                 )
 server=app.server
 #### need to make a way to swap between localhost and 
 cache = Cache(app.server, config=cacheconfig)
 timeout = 300
+# serialisation of the dcc.Store contents: json, orjson or packed (see codec.py)
+store_codec=environ.get('STORE_CODEC', 'orjson')
+# 'cube' for the dense (farm, y, x) cubes, 'sparse' for the per-farm footprints,
+# 'memmap' for the cubes mapped from the .npy files (preprocess.py memmap)
+density_store=environ.get('DENSITY_STORE', 'cube')
+# serve the density map as xyz tiles instead of one image in the figure
+use_tiles=environ.get('DENSITY_TILES', '0')=='1'
+# address of the tile server as seen by the browser, relative to the page by default,
+# it is not read from the request as the map may be drawn in a Celery worker
+tile_base_url=environ.get('TILE_BASE_URL', '/')
+# cap on the cells of a rendered image, the grid is averaged down above it
+max_render_pixels=int(environ['MAX_RENDER_PIXELS']) if 'MAX_RENDER_PIXELS' in environ else None
+# memory for the density levels loaded at startup, shared by the gunicorn workers
+preload_budget=float(environ.get('PRELOAD_BUDGET_MB', 0))*2**20
+# a render with at most max_delta_farms changed farms updates the last grid,
+# which is summed again after max_delta_updates updates to limit rounding drift
+max_delta_farms=int(environ.get('MAX_DELTA_FARMS', 8))
+max_delta_updates=20
+max_last_sums=16
+# levels rendered from the truncated basis of the cubes (preprocess.py lowrank), e.g. 400,800
+# the error of a render is at most |coeff| times the 'error bound' of the basis
+lowrank_levels=[int(r) for r in environ.get('LOWRANK_LEVELS', '').split(',') if r]
+# rendered images shared between sessions, RENDER_CACHE_MAXMEMORY e.g. 512mb
+render_cache=RenderCache(Redis(environ['REDIS_URL']),
+                         ttl=int(environ.get('RENDER_CACHE_TTL', 24*3600)),
+                         maxmemory=environ.get('RENDER_CACHE_MAXMEMORY'))
+
+def heavy_callback(*dependencies, progress=None):
+    '''
+    Callback run as a background job on the celery workers if enabled.
+    With progress the callback takes set_progress as first argument,
+    a no-op when it runs in the web worker. Triggering the callback again
+    while its job runs terminates the previous job.
+    '''
+    if use_background:
+        return app.callback(*dependencies, background=True, progress=progress)
+    def decorator(func):
+        if progress is None:
+            return app.callback(*dependencies)(func)
+        @wraps(func)
+        def no_progress(*args):
+            return func(lambda value: None, *args)
+        return app.callback(*dependencies)(no_progress)
+    return decorator
 
 @server.route('/_ah/warmup')
 def warmup():
@@ -335,6 +399,48 @@ def warmup():
     # Handle your warmup logic here, e.g. set up a database connection pool
 
 
+@server.route('/tiles/<key>/<int:z>/<int:x>/<int:y>.png')
+def density_tile(key, z, x, y):
+    '''
+    Rasterise a 256x256 tile of a registered scenario on demand
+    '''
+    scenario=cache.get(f'scenario_{key}')
+    if scenario is None:
+        abort(404)
+    bounds=tile_bounds(z, x, y)
+    r=select_level(bounds, resolution, 256, 256)
+    # margin so that the tile edges are covered by the grid
+    viewdata={'xmin':bounds['xmin']-2*r, 'xmax':bounds['xmax']+2*r,
+              'ymin':bounds['ymin']-2*r, 'ymax':bounds['ymax']+2*r}
+    arr=density_grid(r, viewdata, scenario, scenario['plan'])
+    if arr is None or arr.sizes['x']<2 or arr.sizes['y']<2:
+        png=empty_tile()
+    else:
+        png=mk_tile(arr, bounds, scenario['span'], scenario['cmp'])
+    response=Response(png, mimetype='image/png')
+    # the key is a hash of the scenario so the tile never changes
+    response.headers['Cache-Control']='public, max-age=86400, immutable'
+    return response
+
+@server.route('/render_cache/stats')
+def render_cache_stats():
+    return jsonify(render_cache.stats())
+
+@cache.memoize()
+def empty_tile(size=256):
+    buffer=io.BytesIO()
+    Image.new('RGBA', (size, size), (0, 0, 0, 0)).save(buffer, format='png')
+    return buffer.getvalue()
+
+def reference_data():
+    '''
+    Static farm, biomass and lice data of this process
+    '''
+    return load_registry(rootdir)
+
+logger.info('loading reference data')
+reference_data()
+
 app.title="Heatmap Dashboard"
 app.layout = dbc.Container([
     html.Div([    #Store
@@ -366,50 +472,168 @@ app.layout = dbc.Container([
         ])    
      ], fluid=True, className='dbc')
 
-# there is a chance that this is shared between users...
+# the stores are shared between users and read only, renders never write to them.
+# They are opened once per process, the levels preloaded in the gunicorn
+# master (preload_app) are shared by the forked workers
+@lru_cache(maxsize=None)
+def cube_store(r):
+    if density_store=='memmap':
+        # mapped files, the workers share the page cache
+        logger.info(f'mapping the {r}m cubes')
+        return load_memmap_cube(rootdir+f'curr_{r}m_cube.npy'), load_memmap_cube(rootdir+f'planned_{r}m_cube.npy')
+    pathtocube=f'curr_{r}m_cube.zarr'
+    pathtofut=f'planned_{r}m_cube.zarr'
+    logger.info(f'using cube store {pathtocube}')
+    super_cube=load_density_cube(rootdir+pathtocube)
+    logger.debug(f'cube chunks:   {super_cube.chunks}')
+    planned_cube=load_density_cube(rootdir+pathtofut)
+    if r in memory_levels:
+        logger.info(f'loading the {r}m cubes in memory')
+        super_cube, planned_cube = super_cube.load(), planned_cube.load()
+    return super_cube, planned_cube
+
+@lru_cache(maxsize=None)
+def footprint_store(r):
+    pathtofp=f'curr_{r}m_sparse.zarr'
+    pathtofut=f'planned_{r}m_sparse.zarr'
+    logger.info(f'using footprint store {pathtofp}')
+    in_memory=r in memory_levels
+    return load_footprints(rootdir+pathtofp, in_memory), load_footprints(rootdir+pathtofut, in_memory)
+
+@lru_cache(maxsize=None)
+def lowrank_store(r):
+    logger.info(f'using the low-rank basis of the {r}m cubes')
+    return load_lowrank(rootdir+f'curr_{r}m_lowrank.zarr'), load_lowrank(rootdir+f'planned_{r}m_lowrank.zarr')
+
+def preload_levels(budget):
+    '''
+    Levels of the density store held in memory, from the coarsest
+    while their total size stays within budget (bytes)
+    '''
+    levels, used = [], 0
+    for r in sorted(resolution, reverse=True):
+        if density_store=='sparse':
+            size=sum(load_footprints(rootdir+f'{prefix}_{r}m_sparse.zarr')['values'].nbytes for prefix in ['curr', 'planned'])
+        else:
+            size=sum(load_density_cube(rootdir+f'{prefix}_{r}m_cube.zarr').nbytes for prefix in ['curr', 'planned'])
+        if used+size>budget:
+            break
+        levels.append(r)
+        used+=size
+    logger.info(f'{used/2**20:.0f} MB of density levels {levels} preloaded')
+    return levels
+
+@lru_cache(maxsize=None)
+def mask_store(r):
+    logger.info(f'using masks mask_{r}m.zarr')
+    return load_masks(rootdir+f'mask_{r}m.zarr')
+
+# keyed by the resolution and a hash of the polygons
 @cache.memoize()
-def global_store(r):
-    pathtods=f'curr_{r}m.zarr'
-    pathtofut=f'planned_{r}m.zarr'
-    logger.info(f'using global store {pathtods}')
-    super_ds=open_zarr(rootdir+pathtods)#.drop('North Kilbrannan')
-    super_ds=super_ds.where(super_ds.x<-509945) # remove the border
-    logger.debug(f'zarr chunks:   {super_ds.chunks}')
-    planned_ds= open_zarr(rootdir+pathtofut)
-    return super_ds, planned_ds
-
-@cache.memoize    
+def selection_store(r, selection):
+    logger.info(f'rasterising the selection at {r}m')
+    return selection_cells(mask_store(r), selection)
+
+# the memmap cubes are paged in by the OS and shared through the page cache
+memory_levels=preload_levels(preload_budget) if preload_budget>0 and density_store!='memmap' else []
+for level in memory_levels:
+    if density_store=='sparse':
+        footprint_store(level)
+    else:
+        cube_store(level)
+    mask_store(level)
+
+def sum_farms(r, viewdata, coeff, names, planned=False):
+    '''
+    Sum the scaled contributions of the existing (or planned) farms
+    on the viewport with the configured density store
+    without modifying the store
+    '''
+    if r in lowrank_levels:
+        lowrank=lowrank_store(r)[1 if planned else 0]
+        arr=lowrank_sum(crop_view(lowrank, viewdata), coeff, names)
+    elif density_store=='sparse':
+        fp=footprint_store(r)[1 if planned else 0]
+        arr=accumulate_footprints(fp, coeff, names, view_window(fp, viewdata))
+    else:
+        cube=cube_store(r)[1 if planned else 0]
+        arr=weighted_sum(crop_view(cube, viewdata), coeff, names)
+    masks=mask_store(r)
+    arr=apply_mask(arr, masks['land'])
+    if not planned:
+        arr=apply_mask(arr, masks['border'])
+    return arr
+
+# last sums of each level and viewport: (farm coefficients, grid, number of updates)
+last_sums=OrderedDict()
+
+def farm_deltas(previous, coeff):
+    '''
+    Farms whose coefficient changed and the change
+    '''
+    deltas={farm:coeff.get(farm, 0)-previous.get(farm, 0) for farm in set(previous)|set(coeff)}
+    return {farm:delta for farm, delta in deltas.items() if delta!=0}
+
+@lru_cache(maxsize=int(environ.get('PARTIAL_SUM_CACHE', 32)))
+def unit_sum(r, view, names, unit_coeff, planned=False):
+    '''
+    Sum of the farms with their unit coefficients, before the global knobs,
+    on the viewport corners (xmin, xmax, ymin, ymax).
+    Cached per process by level, viewport, farms and unit coefficients
+    (i.e. year and toggles) so that turning a knob is a single multiply.
+    If only a few farms changed since the last sum on this level and viewport
+    (farm switched on/off or tuned) the last grid is updated with their
+    contributions only: grid += delta_i * field_i
+    '''
+    viewdata=dict(zip(['xmin','xmax','ymin','ymax'], view))
+    coeff=dict(zip(names, unit_coeff))
+    key=(r, view, planned)
+    grid=None
+    if key in last_sums:
+        previous, last_grid, updates = last_sums[key]
+        deltas=farm_deltas(previous, coeff)
+        if len(deltas)<=max_delta_farms and updates<max_delta_updates:
+            logger.info(f'updating the last grid with {len(deltas)} farms')
+            delta_grid=sum_farms(r, viewdata, np.array(list(deltas.values())), list(deltas.keys()), planned)
+            grid, updates = last_grid+delta_grid.compute(), updates+1
+    if grid is None:
+        grid, updates = sum_farms(r, viewdata, np.array(unit_coeff), list(names), planned).compute(), 0
+    last_sums[key]=(coeff, grid, updates)
+    last_sums.move_to_end(key)
+    while len(last_sums)>max_last_sums:
+        last_sums.popitem(last=False)
+    return grid
+
+def density_grid(r, viewdata, dataset, plan):
+    '''
+    Render the density grid of the scenario on the viewport:
+    the selected existing farms scaled by their coefficients
+    plus the checked planned farms scaled by the lice/egg factor.
+    The knobs only scale the cached partial sums.
+    Returns None if there is nothing to render.
+    '''
+    view=tuple(float(viewdata[c]) for c in ['xmin','xmax','ymin','ymax'])
+    grid=None
+    if plan['existing']:
+        logger.info('Summing the existing farms')
+        grid=unit_sum(r, view, tuple(dataset['name list']), tuple(dataset['unit coeff']))*dataset['global factor']
+    if plan['planned'] and len(plan['checklist'])>0:
+        logger.info('adding planned farms')
+        logger.debug(f"scaling planned with {dataset['lice/egg factor']}")
+        planned_grid=unit_sum(r, view, tuple(plan['checklist']), (1.,)*len(plan['checklist']), True)*dataset['lice/egg factor']
+        grid=planned_grid if grid is None else grid+planned_grid
+    if grid is not None and r in lowrank_levels:
+        # the densities are positive, remove the ringing of the truncated basis
+        grid=grid.clip(min=0)
+    return grid
+
 @app.callback(
      Output('init', 'data'),
      Input(ThemeSwitchAIO.ids.switch("theme"), "value"),
 )
 def initialise_var(toggle):
-    logger.info('Preparing dataset')
-    variables={}
-    master='curr_800m.zarr'
-    super_ds=xr_opening(rootdir+master)#.drop('North Kilbrannan')
-    variables['All_names']=np.array(list(super_ds.keys()))
-    variables['future_farms']=read_future_farms(rootdir+'farm_data/future_farms.txt')
-    variables['ref_biom']=np.zeros(len(variables['All_names']))
-    liceStore='farm_data/consolidated_sealice_data_2017-2021.zarr'
-    lice_data=xr_opening(rootdir+liceStore)
-    ### Correct typos in the raw data
-    id_c=250
-    typos =['Fs0860', 'Fs1018', 'Fs1024'] 
-    correct=['FS0860', 'FS1018', 'FS1024']
-    for mess, ok in zip(typos, correct):
-        lice_data[ok].values[id_c]=lice_data[mess].values[id_c]
-        lice_data=lice_data.drop(mess)
-    variables['lice_data']=lice_data.to_dict()
-    variables['lice time']=variables['lice_data']['coords']['time']['data']
-    csvfile='farm_data/biomasses_to_03-2023.csv'
-    variables['farm_data'], variables['times'], _ , variables['Ids'] =read_farm_data(rootdir+csvfile, lice_data, super_ds.keys())
-    logger.info('Farm loaded')
-    sepacsv= 'farm_data/SEPA_GSID.csv'
-    variables['farm_data']=add_new_SEPA_nb(rootdir+sepacsv, variables['farm_data'])
-    logger.info('Variables loaded')
-    return json.dumps(variables, cls= JsonEncoder) 
-#orjson.dumps(variables, option= orjson.OPT_NAIVE_UTC | orjson.OPT_SERIALIZE_NUMPY)
+    # the data stay on the server, the session only holds their version
+    return dumps_store({'version':reference_data()['version']}, store_codec)
 
 @app.callback(
     Output('theme_store', 'data'),
@@ -421,7 +645,7 @@ def record_theme(toggle):
     theme['template'] = template_theme1 if toggle else template_theme2
     theme['cmp']= cmp1 if toggle else cmp2
     theme['carto_style']= carto_style1 if toggle else carto_style2
-    return json.dumps(theme)
+    return dumps_store(theme, store_codec)
 
 @app.callback(
     Output('egg_toggle_output','children'),
@@ -443,25 +667,13 @@ def toggle_egg_models(eggs):
 def compute_lice_data(liceC, egg, meas, init):
     logger.info('scaling lice')
     logger.debug(f'egg is {egg}')
-    variables=json.loads(init)
+    variables=reference_data()
     # modify egg model from Rittenhouse (16.9) to Stein (30)
-    if egg:
-        c_lice=30/16.9
-    else:
-        c_lice=1
-    lice_factor=np.ones(len(variables['All_names']))
-    if not meas:
-        liceC *=2
-        if liceC==0:
-            liceC=0.00001
-        lice_factor*=liceC
-    logger.debug(f'c_lice: {c_lice}')
-    lice_factor *= c_lice
-    logger.debug(f'lice_factor: {lice_factor[0]}')
-    logger.debug(f'liceC: {liceC}')
-    return [{'lice factor': lice_factor, 
-                       'lice knob': liceC, 
-                       'egg factor': c_lice}]
+    lice=lice_factors(len(variables['farms']), liceC, egg, meas)
+    logger.debug(f"c_lice: {lice['egg factor']}")
+    logger.debug(f"lice_factor: {lice['lice factor'][0]}")
+    logger.debug(f"liceC: {lice['lice knob']}")
+    return [lice]
     
 @app.callback(
     Output('view_store','data'),
@@ -491,9 +703,9 @@ def store_viewport(relay):
         bbox=default_view
     corners=calculate_edge(np.array(bbox))
     corners['zoom']=zoom
-    res=select_zoom(zoom)
+    res=view_level(corners)
 
-    return json.dumps(corners, cls= JsonEncoder), f'Render density map at {res}m resolution'
+    return dumps_store(corners, store_codec), f'Render density map at {res}m resolution'
     
 @app.callback(
     Output('selection_store','data'),
@@ -519,7 +731,7 @@ def store_selections(selection):
                       [corners[1][0],corners[0][1]],
                       corners[0]]]
             #logger.debug(f'rectangle: {polygon}')        
-    return json.dumps(polygon, cls= JsonEncoder)
+    return dumps_store(polygon, store_codec)
 
 @app.callback(
     Output('bubbles','data'),
@@ -536,45 +748,11 @@ def store_selections(selection):
     ],
 )
 def mk_bubbles(year, biomC,lice_tst, init, liceData, biom_tog, meas):
-    liceData=liceData[0]
-    variables=json.loads(init)
-    activated_farms= np.ones(len(variables['All_names']), dtype='bool')
-    Coeff=np.ones(len(variables['All_names'])) 
-    biomass_factor=np.zeros(len(variables['All_names']))
-    lice_factor=np.array(liceData['lice factor'])
-    if biomC ==0:
-        biomC=0.00001
-    biomC /=100
-    logger.debug(f'biomC: {biomC}')
     logger.info('preparing lice factor')
-    idx, biomass_factor, lice_factor, ref_biom=fetch_biomass(variables['farm_data'], variables['lice_data'], 
-                                                     activated_farms, biomass_factor, lice_factor, 
-                                                     np.array(variables['times'],dtype='datetime64[D]'), 
-                                                     np.array(variables['ref_biom']), variables['Ids'], 
-                                                     np.array(variables['lice time'], dtype= "datetime64[D]"),
-                                                     meas, year)
-    name_list=np.array(list(variables['farm_data'].keys()))[idx]
-    if not biom_tog:
-        biomass_factor=np.ones(len(variables['All_names']))
-    ##### update discs farms
-    current_biomass=[variables['farm_data'][farm]['licensed peak biomass']*
-                                    biomass_factor[variables['farm_data'][farm]['ID']] *biomC
-                                    for farm in name_list]
-        # set global factor biomass x individual farm biom x individual lice x egg model
-    logger.debug(f'idx:      {type(idx)}')
-    logger.debug(f'biomass factor:      {biomass_factor}')
-    logger.debug(f'lice factors:      {lice_factor}')
-    Coeff=biomC*biomass_factor[idx]*lice_factor[idx]
-    alllice=(Coeff*ref_biom[idx]).sum()*1000*0.5*16.7/4.5 #running in circles... running parameters
-    return json.dumps({ 
-         'coeff': Coeff,
-         'all lice': alllice,
-         'name list': name_list,
-         'current biomass':current_biomass,
-         'year': year,
-         'biomass knob':biomC,
-         'lice/egg factor':liceData['lice knob']*liceData['egg factor'],
-         }, cls= JsonEncoder)
+    dataset=scenario_coefficients(reference_data(), year, biomC, liceData[0], biom_tog, meas)
+    logger.debug(f"biomass knob:      {dataset['biomass knob']}")
+    logger.debug(f"coefficients:      {dataset['coeff']}")
+    return dumps_store(dataset, store_codec)
      
 @app.callback(
     [Output('LED_biomass','value'),
@@ -586,7 +764,7 @@ def populate_LED(bubble_data):
     if bubble_data is None:
         raise PreventUpdate
     logger.info('modifying LED values')
-    dataset= json.loads(bubble_data)
+    dataset= loads_store(bubble_data)
     return int(sum(dataset['coeff'])*1000), int(dataset['all lice'])
     
 @app.callback(
@@ -607,12 +785,12 @@ def store_planned_farms(toggle_planned, checklist, toggle_existing):
     )
 def init_checklist(init):
     logger.info('generating checklist')
-    variables=json.loads(init)
+    variables=reference_data()
     plans=[l[1] for l in variables['future_farms']]
     return plans, plans
 
 
-@app.callback(
+@heavy_callback(
     [Output('heatmap', 'figure'),
     Output('heatmap_output', 'children'),
     Output('modal_div', 'children')
@@ -630,14 +808,15 @@ def init_checklist(init):
     State('view_store','data'),
     State('planned_store', 'data'),   
     ],
+    progress=[Output('heatmap_progress', 'children')],
 )
-def redraw( theme, span, trigger, init, bubble_data,  fig,  viewport, plan): 
+def redraw(set_progress, theme, span, trigger, init, bubble_data,  fig,  viewport, plan): 
     logger.info('drawing the map')
     ctx = dash.callback_context
-    dataset= json.loads(bubble_data)
-    viewdata= json.loads(viewport)
-    theme=json.loads(theme)
-    variables=json.loads(init)
+    dataset= loads_store(bubble_data)
+    viewdata= loads_store(viewport)
+    theme=loads_store(theme)
+    variables=reference_data()
     origin=[]
     is_open=False
 
@@ -647,9 +826,10 @@ def redraw( theme, span, trigger, init, bubble_data,  fig,  viewport, plan):
     fig['data'][0]['marker']['colorscale']=mk_colorscale(theme['cmp']) #mk_colorscale(theme['cmp'])
     fig['data'][0]['marker']['cmax']=span[1]
     fig['data'][0]['marker']['cmin']=span[0]
-    fig['data'][2]['lat']=[variables['farm_data'][farm]['lat'] for farm in variables['farm_data'].keys()]
-    fig['data'][2]['lon']=[variables['farm_data'][farm]['lon'] for farm in variables['farm_data'].keys()]
-    fig['data'][2]['text']=[farm for farm in variables['farm_data'].keys()]
+    farms=variables['farms']
+    fig['data'][2]['lat']=farms['lat'].tolist()
+    fig['data'][2]['lon']=farms['lon'].tolist()
+    fig['data'][2]['text']=farms['name'].tolist()
     fig['data'][3]= go.Scattermapbox(
          lat=[l[3] for l in variables['future_farms']],
          lon=[l[-1] for l in variables['future_farms']],
@@ -667,9 +847,10 @@ def redraw( theme, span, trigger, init, bubble_data,  fig,  viewport, plan):
          )
     
     ### draw bubbles 
+    bubble_ids=np.array([variables['farm index'][farm] for farm in dataset['name list']], dtype='int64')
     fig['data'][1]=go.Scattermapbox(
-                                lat=[variables['farm_data'][farm]['lat'] for farm in dataset['name list']],
-                                lon=[variables['farm_data'][farm]['lon'] for farm in dataset['name list']],
+                                lat=farms['lat'][bubble_ids].tolist(),
+                                lon=farms['lon'][bubble_ids].tolist(),
                                 text=dataset['name list'],
                                 hovertemplate="<b>%{text}</b><br><br>" + \
                                         "Biomass: %{marker.size:.0f} tonnes<br>",
@@ -687,40 +868,29 @@ def redraw( theme, span, trigger, init, bubble_data,  fig,  viewport, plan):
        ctx.triggered[0]['prop_id'] =='span-slider.value': 
         logger.debug(f"Existing toggle is {plan['existing']}, Planned toggle is {plan['planned']}")
         if plan['existing'] or plan['planned']:
-            logger.info('rasterizing the heatmap')
-            r = select_zoom(viewdata['zoom'])
-            logger.debug('zoom: {}, resolution: {}'.format(viewdata['zoom'], r))
-            super_ds, planned_ds=global_store(r)
-            logger.info('global store loaded')
-            if plan['existing']:
-                logger.info('Cropping super ds')
-                ds= crop_ds(super_ds, viewdata)
-                name_list=dataset['name list'] # [1:] #### remove Achintraid because only NaN for some reason
-                logger.info('Cropped')
-                ds=ds[name_list]
-                logger.info('Scaling the super ds with parameters')
-                for i in range(len(name_list)):                    
-                    ds[name_list[i]].values *=dataset['coeff'][i]
-                logger.info('Scaled')    
+            if not plan['existing'] and len(plan['checklist'])==0:
+                origin.append("no future")
+                is_open=True
+                fig['layout']['mapbox']['layers']=[]
+            elif use_tiles:
+                scenario=mk_scenario(dataset, plan, span, theme)
+                key=scenario_key(scenario)
+                cache.set(f'scenario_{key}', scenario, timeout=24*3600)
+                logger.info(f'serving tiles of scenario {key}')
+                fig['layout']['mapbox']['layers']=tile_layer(key)
+            else:
+                logger.info('rasterizing the heatmap')
+                r = view_level(viewdata)
+                logger.debug('zoom: {}, resolution: {}'.format(viewdata['zoom'], r))
+                set_progress(f'Rendering the density map at {r}m')
+                png, coordinates = cached_render(r, viewdata, mk_scenario(dataset, plan, span, theme))
+                set_progress('Drawing the map')
+                name_list=[]
+                if plan['existing']:
+                    name_list=dataset['name list']
                 if plan['planned']:
-                    logger.info('adding planned farms')
-                    planned_ds=crop_ds(planned_ds, viewdata)
                     name_list=np.hstack((name_list,plan['checklist']))
-                    logger.debug(f"scaling planned with {dataset['lice/egg factor']}")
-                    for var in plan['checklist']:
-                        ds[var]=planned_ds[var]*dataset['lice/egg factor']
-                    logger.info('added and scaled planned farms')
-                fig=render(fig, ds,span, theme, name_list)
-            else:
-                logger.info('adding only planned farms')
-                if len(plan['checklist'])>0:
-                    ds=crop_ds(planned_ds[plan['checklist']]*dataset['lice/egg factor'], viewdata)
-                    name_list=plan['checklist']
-                    fig=render(fig, ds, span, theme, name_list)
-                else:
-                    origin.append("no future")
-                    is_open=True
-                    fig['layout']['mapbox']['layers']=[]
+                fig=render(fig, png, coordinates, name_list)
         else:
             origin.append("no toggle")
             is_open=True
@@ -739,7 +909,7 @@ def grab_farm(select, data):
     else: 
         name= select['points'][0]['text']
         logger.debug (f"{name} was selected")
-        variables=json.loads(data)
+        variables=reference_data()
         l=[l[1] for l in variables['future_farms']]
         if name in l:
             return f'{name} has no record', True
@@ -764,9 +934,8 @@ def inspect_farm(click, name):
 )
 def populate_dropdown(init):
     logger.info('populating farm dropdown')
-    logger.debug(f' serialised: {init[10980:11000]}')
-    variables=json.loads(init)
-    return variables['All_names']
+    variables=reference_data()
+    return variables['All_names'].tolist()
 
 
 @app.callback([
@@ -779,29 +948,30 @@ def populate_dropdown(init):
     State('progress-curves','figure'),
 )
 def farm_inspector(name, theme, init, curves):
-    theme=json.loads(theme)
-    variables=json.loads(init)
+    theme=loads_store(theme)
+    variables=reference_data()
     template = theme['template']    
     logger.debug(f'curve name: {name}')  
     time_range=   np.array([variables['times'][0],variables['times'][-1]], dtype='datetime64[D]')#convert_dates()
-    if not name:
+    if not name or name not in variables['farm index']:
         raise PreventUpdate
     else:
+        row=variables['farm index'][name]
         for i in range(4): # try to 0 de values
             curves['data'][i]['x']=[None]
             curves['data'][i]['y']=[None]
         curves['data'][0]['x']=np.array(variables['times'], dtype='datetime64[D]')
-        curves['data'][0]['y']=variables['farm_data'][name]['biomasses']
+        curves['data'][0]['y']=variables['biomass'][row]
         curves['data'][1]['x']=np.array(variables['lice time'], dtype='datetime64[D]')
-        curves['data'][1]['y']=variables['farm_data'][name]['lice data']
+        curves['data'][1]['y']=variables['lice'][row]
         curves['data'][2]['y']=[0.5,0.5]
         curves['data'][2]['x']= time_range 
         curves['data'][3]['x']= time_range 
-        curves['data'][3]['y']=[variables['farm_data'][name]['mean lice'], variables['farm_data'][name]['mean lice']]      
+        curves['data'][3]['y']=[variables['farms']['mean lice'][row], variables['farms']['mean lice'][row]]
         #curves=farm_plot(name, variables['times'], variables['farm_data'][name], variables['lice_data'], template)
         curves['layout']['template']=mk_template(template)
         logger.debug(curves)
-        return curves, mk_farm_layout(name, marks_biomass,marks_lice, variables['farm_data'][name])
+        return curves, mk_farm_layout(name, marks_biomass,marks_lice, farm_record(variables, name))
 
     
 @app.callback(
@@ -827,7 +997,7 @@ def open_tuning_collapse(n, is_open):
     return is_open
 
 
-@app.callback(
+@heavy_callback(
     Output("tab2_store",'data'),  
     Input('selection_store','data'),
     Input('view_store','data'),
@@ -837,8 +1007,8 @@ def open_tuning_collapse(n, is_open):
 def compute_selection_stats(selection,view, bubble_data, plan):
     if selection is None or bubble_data is None:
         raise PreventUpdate 
-    selection=json.loads(selection)
-    dataset=json.loads(bubble_data) 
+    selection=loads_store(selection)
+    dataset=loads_store(bubble_data) 
     tab2={'counts':{},
           'max':{},
           'mean':{},
@@ -847,19 +1017,21 @@ def compute_selection_stats(selection,view, bubble_data, plan):
         raise PreventUpdate   
     else:
         
-        r = select_zoom(json.loads(view)['zoom'])
+        r = view_level(loads_store(view))
         tab2['resolution']=r
-        super_ds, planned_ds=global_store(r)
         name_list=dataset['name list']
-        for i in range(len(name_list)):                    
-            super_ds[name_list[i]].values *=dataset['coeff'][i]
-        cropped_current=super_ds.rio.write_crs(3857, inplace=True).rio.clip(selection, crs=4326)[name_list]
-        stack_current=cropped_current.to_stacked_array('v', ['y', 'x']).sum(dim='v').compute()
-        if len(plan['checklist'])>0:
-            cropped_planned=planned_ds.rio.write_crs(3857, inplace=True).rio.clip(selection, crs=4326)[plan['checklist']]
-            stack_planned=cropped_planned.to_stacked_array('v', ['y', 'x']).sum(dim='v').compute()*dataset['lice/egg factor']
+        cells=selection_store(r, selection)
+        # the existing farms are cut at the border as on the map
+        current_cells=mask_cells(cells, mask_store(r)['border'])
+        planned_coeff=np.ones(len(plan['checklist']))
+        if density_store=='sparse':
+            super_fp, planned_fp=footprint_store(r)
+            cropped_current=footprint_moments(super_fp, dataset['coeff'], name_list, current_cells)
+            cropped_planned=footprint_moments(planned_fp, planned_coeff, plan['checklist'], cells)
         else:
-            stack_planned=DataArray()
+            super_cube, planned_cube=cube_store(r)
+            cropped_current=cube_moments(super_cube, dataset['coeff'], name_list, current_cells)
+            cropped_planned=cube_moments(planned_cube, planned_coeff, plan['checklist'], cells)
 
     ### statistics counts of cells with values, max concentrations, average, stdv  
         dslist=  [cropped_current, cropped_planned]
@@ -876,39 +1048,29 @@ def compute_selection_stats(selection,view, bubble_data, plan):
             tab2['mean'][subt[d]]=0
             tab2['max'][subt[d]]=0
             tab2['stdv'][subt[d]]=0
+        # count, max, sum and sum of squares of each group
+        groups=[]
         for d in range(2): 
-            Nb.append(len(dslist[d].keys()))          
-            for farm in dslist[d].keys():                            
+            Nb.append(len(dslist[d].keys()))
+            group=np.zeros(4)
+            for farm, moments in dslist[d].items():
                 if farm in plan['checklist']:
                     den=dataset['lice/egg factor']
                 else:
                     den=1
                 factor=den*1000000/(tab2['resolution']**2)
-                arr= dslist[d][farm].compute()
-                if arr.count().item()>0:
-                    tab2['counts'][farm], tab2['max'][farm], tab2['mean'][farm], tab2['stdv'][farm]=arr.count().item(), \
-                        arr.max().item()*factor, \
-                        arr.sum().item()*factor, \
-                        arr.std().item()*factor
-                    tab2['counts'][subt[d]]+=tab2['counts'][farm]
-                    tab2['max'][subt[d]]=max(tab2['max'][subt[d]], tab2['max'][farm])
-                    tab2['mean'][subt[d]]+=tab2['mean'][farm]
-                    #tab2['stdv'][subt[d]]+=tab2['stdv'][farm]
-                    tab2['mean']['All']+=tab2['mean'][farm]
-                    #tab2['stdv']['All']+=tab2['stdv'][farm]
-                    tab2['mean'][farm]/=tab2['counts'][farm] #only calculate now
-            if tab2['counts'][subt[d]] >0:
-                tab2['mean'][subt[d]] /=tab2['counts'][subt[d]]
-            else:
-                tab2['mean'][subt[d]] = np.nan
-            tab2['stdv'][subt[d]] =np.nan
-                
-    tab2['max']['All']=max(tab2['max'][subt[0]], tab2['max'][subt[0]])
-    tab2['mean']['All']/=(tab2['counts'][subt[0]]+tab2['counts'][subt[1]])
+                if moments[0]>0:
+                    moments=scale_moments(moments, factor)
+                    tab2['counts'][farm], tab2['max'][farm], tab2['mean'][farm], tab2['stdv'][farm]=moment_stats(moments)
+                    group=combine_moments([group, moments])
+            groups.append(group)
+            tab2['counts'][subt[d]], tab2['max'][subt[d]], tab2['mean'][subt[d]], tab2['stdv'][subt[d]]=moment_stats(group)
+    # the cells of the groups overlap so the count of All is unknown
+    _, tab2['max']['All'], tab2['mean']['All'], tab2['stdv']['All']=moment_stats(combine_moments(groups))
       
     logger.debug(tab2)
     logger.debug('tab2 data stored')
-    return json.dumps(tab2, cls= JsonEncoder)
+    return dumps_store(tab2, store_codec)
 
 @app.callback(
     Output('counts','figure'),
@@ -928,12 +1090,12 @@ def draw_statistics(tab2, fig1,fig2,fig3,fig4):
         raise PreventUpdate
     else:
         logger.info('Drawing area statistics')
-        stats=json.loads(tab2)
+        stats=loads_store(tab2)
         for val,fig in zip(['counts','max','mean','stdv'],[fig1,fig2,fig3,fig4]):
             fig['data'][0]['x']=list(stats[val].keys())
             fig['data'][0]['y']=list(stats[val].values())
         #logger.debug(fig['data'][0]['x'])       
-        fig1['data'][0]['y']=[float(x)*stats['resolution']**2/1000000 for x in fig1['data'][0]['y']]
+        fig1['data'][0]['y']=[as_float(x)*stats['resolution']**2/1000000 for x in fig1['data'][0]['y']]
 
                 #data.append(stats[var])
                 #columns.append(var)
@@ -954,14 +1116,14 @@ def make_csv(n_clicks,tab2):
     if tab2 is None:
         raise PreventUpdate
     else:
-        stats=json.loads(tab2)
+        stats=loads_store(tab2)
         data=Mktab(stats)
         logger.debug(data)
         tab='name,area,max,mean,stdv\n(units),(km²),(Copepodid),(Copepodid),(Copepodid)\n'
         for i in range(len(data)):
-           l=list(data[i].values())
-           if l[1] != 'nan':
-               l[1]=float(l[1])*(stats['resolution']**2)/1000000
+           row=list(data[i].values())
+           l=[row[0]]+[as_float(x) for x in row[1:]]
+           l[1]=l[1]*(stats['resolution']**2)/1000000
            l=[str(x) for x in l]
            logger.debug(l)
            tab+=','.join(l)+'\n'
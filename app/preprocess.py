@@ -1,84 +1,124 @@
 from scipy.spatial import KDTree
-import logging
+import logging, hashlib, warnings, json
+from os import path
 import numpy as np
 import xarray as xr
-from datetime import datetime, timedelta
+import dask
+import dask.array as da
+from numcodecs import Blosc
+from rasterio.features import geometry_mask
+from affine import Affine
 
-def add_new_SEPA_nb(sepafile, farm_data):
+logger = logging.getLogger('sealice_logger')
+
+def read_SEPA_GSID(sepafile):
     '''
-    Add information from new SEPA GSID to modelled farms
+    Read the new SEPA GSID of the modelled farms
     '''
+    gsid={}
     with open(sepafile) as ff:
        ff.readline()
        for line in ff:
            line=line.strip().split(',')
-           try:
-               farm_data[line[0]]['GSID']=line[1]
-           except:
-               logger.debug(f'new SEPA numbers not found for {line[0]} ')
-    return farm_data
-
-def read_farm_data(farmfile, lice_data, ds_names):
-    data={}
-    logger.info('########## READING BIOMASS DATA #######')
+           if len(line)>1:
+               gsid[line[0]]=line[1]
+    return gsid
+
+# columns of the biomass csv, the biomass time series start at first_biomass
+meta_columns={'name':0,
+              'additional location':1,
+              'Name MS':2,
+              'Site ID SEPA':3,
+              'Site ID Scot env':4,
+              'Prod year':9,
+              'operator':13,
+              'production cycle':14,
+              'production in 3 years 2021':18,
+              }
+first_biomass=21
+
+def parse_floats(cells, dtype='float32'):
+    '''
+    Convert an array of strings to floats, empty or invalid cells are NaN
+    '''
+    cells=np.char.strip(cells)
+    try:
+        return np.where(cells=='', 'nan', cells).astype(dtype)
+    except ValueError:
+        def to_float(cell):
+            try:
+                return float(cell)
+            except ValueError:
+                return np.nan
+        return np.vectorize(to_float, otypes=[dtype])(cells)
+
+def file_key(filename):
+    '''
+    Modification time and content hash of a file
+    '''
+    with open(filename, 'rb') as f:
+        digest=hashlib.sha1(f.read()).hexdigest()
+    return f'{path.getmtime(filename)}:{digest}'
+
+def parse_farm_csv(farmfile):
+    '''
+    Parse the whole biomass csv at once into string columns,
+    the (farm, time) float32 biomass matrix and the times
+    '''
     with open(farmfile) as f:
-        head=f.readline().strip().split(',')[21:]
-        times = np.array([np.datetime64(datetime.strptime(h,'%Y-%m-%d')) for h in head])
+        head=f.readline().strip().split(',')[first_biomass:]
         f.readline()
-        id=0
-        for line in f:   
-            line=line.strip().split(',')
-            if line[0] in ds_names:
-                data[line[0]]= {'additional location':line[1],
-                            'Name MS': line[2],
-                            'Site ID SEPA': line[3].strip(),
-                            'Site ID Scot env':str(line[4]).strip(),
-                            'Prod year':line[9],
-                            'operator':line[13],
-                            'production cycle':line[14],
-                            'production in 3 years 2021': line[18],
-                            'ID':id,
-                            #'odd':random() < 0.5,
-                            }
-                try:
-                    data[line[0]]['lat']=float(line[6])
-                    data[line[0]]['lon']=float(line[7])
-                except:
-                    log.debug(f'No lat lon for line[0] in csv') 
-                id+=1
-                ref=0
-                biom=np.zeros(len(line[21:]))
-                for i in range(len(line[21:])):
-                    try:
-                        b = float(line[21+i])
-                        biom[i]=b
-                        if b>ref:
-                            ref=b
-                    except:
-                        biom[i]=np.nan
-                data[line[0]]['max biomass']= ref
-                # deal with inconsistencies
-                if len(line[10])>0:
-                    data[line[0]]['licensed peak biomass']= float(line[10])
-                else:
-                    data[line[0]]['licensed peak biomass']= ref
-                    logger.info(f'Using max recorded biomass for undocumented license of {line[0]}')          
-                data[line[0]]['biomasses']=biom
-                data[line[0]]['lice data'], data[line[0]]['mean lice']=add_lice_data(line[4], lice_data)       
-                if ref==0:
-                    id -=1 
-                    del data[line[0]]
-            else:
-                logger.debug(f'{line[0]} not in dataset')
+        rows=[line.strip().split(',') for line in f if len(line.strip())>0]
+    times=np.array(head, dtype='datetime64[D]')
+    width=first_biomass+len(head)
+    cells=np.array([row[:width]+['']*(width-len(row)) for row in rows], dtype=str)
+    table={field:np.char.strip(cells[:,col]) for field, col in meta_columns.items()}
+    table['lat']=parse_floats(cells[:,6], 'float64')
+    table['lon']=parse_floats(cells[:,7], 'float64')
+    table['licensed peak biomass']=parse_floats(cells[:,10], 'float64')
+    table['biomass']=parse_floats(cells[:,first_biomass:])
+    table['times']=times
+    return table
+
+def read_farm_table(farmfile, ds_names, cache=True):
+    '''
+    Read the farms of the biomass csv that are in the dataset.
+    The parsed csv is cached in farmfile.npz, keyed by the csv
+    modification time and hash.
+    Returns the farm columns (including the (farm, time) biomass matrix)
+    and the times of the biomass data.
+    '''
+    logger.info('########## READING BIOMASS DATA #######')
+    cachefile=farmfile+'.npz'
+    key=file_key(farmfile)
+    table=None
+    if cache and path.exists(cachefile):
+        with np.load(cachefile) as stored:
+            if stored['key'].item()==key:
+                logger.info(f'using cached {cachefile}')
+                table={field:stored[field] for field in stored.files if field!='key'}
+    if table is None:
+        table=parse_farm_csv(farmfile)
+        if cache:
+            try:
+                np.savez(cachefile, key=np.array(key), **table)
+            except OSError:
+                logger.info(f'could not write the biomass cache {cachefile}')
+    times=table.pop('times')
+    # deal with inconsistencies
+    table['max biomass']=np.where(table['biomass']>0, table['biomass'], 0).max(axis=1).astype('float64')
+    keep=np.isin(table['name'], list(ds_names)) & (table['max biomass']>0)
+    logger.debug(f"not in dataset or without biomass: {table['name'][~keep]}")
+    table={field:column[keep] for field, column in table.items()}
+    undocumented=np.isnan(table['licensed peak biomass'])
+    for farm in table['name'][undocumented]:
+        logger.info(f'Using max recorded biomass for undocumented license of {farm}')
+    table['licensed peak biomass'][undocumented]=table['max biomass'][undocumented]
+    table['ID']=np.arange(keep.sum())
     logger.info('########## BIOMASS DATA READ ###########')
-    for farm in ds_names:
-        if farm in data.keys():
-             pass
-        else:
-             logger.info(f'{farm} from dataset not found in biomass data csv')
-    Ids=np.array([data[farm]['Site ID Scot env'] for farm in data.keys()])
-    tree = None #mk_kde_tree(data)
-    return data, times, tree , Ids
+    for farm in np.setdiff1d(list(ds_names), table['name']):
+        logger.info(f'{farm} from dataset not found in biomass data csv')
+    return table, times
 
 def mk_kde_tree(data):
     logger.info('########## Making KDe Tree   ###########')
@@ -97,30 +137,343 @@ def read_future_farms(filename):
                            dtype=['U10','U30','i8','f8','f8'])
     return new_farm
 
-def add_lice_data(SEPA_ID, lice_data):
-    arr= np.zeros(261)
-    arr[:]=np.nan
-    av=np.nan
-    for licence in lice_data.keys():
-        if licence==SEPA_ID:
-            arr= lice_data[licence].values
-            try:
-                av = np.nanmean(lice_data[licence].values)
-            except:
-                logger.info(f'{licence} has no lice data in the lice dataset')
-    return arr, av
+# misspelled licences of the raw lice data and their only record (at index id_c)
+lice_typos={'Fs0860':'FS0860', 'Fs1018':'FS1018', 'Fs1024':'FS1024'}
+
+def index_lice_data(lice_data, typos=lice_typos, id_c=250):
+    '''
+    Index the lice dataset once: a dense (licence, time) float32 array,
+    the licence to row map and the mean lice of every licence.
+    The records of the misspelled licences are moved to the right licence.
+    '''
+    licences=[licence for licence in lice_data.data_vars if licence not in typos]
+    lice=lice_data[licences].to_array(dim='licence').transpose('licence', 'time').values.astype('float32')
+    rows={licence:i for i, licence in enumerate(licences)}
+    ### Correct typos in the raw data
+    for mess, ok in typos.items():
+        if mess in lice_data.data_vars and ok in rows:
+            lice[rows[ok], id_c]=lice_data[mess].values[id_c]
+    with warnings.catch_warnings():
+        # licences without any record
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        mean=np.nanmean(lice, axis=1)
+    return {'rows':rows,
+            'lice':lice,
+            'mean lice':mean,
+            'time':lice_data.time.values.astype('datetime64[D]')}
+
+def add_lice_data(SEPA_ID, lice_index):
+    '''
+    Lice series and mean lice of a licence, NaN if it has no record
+    '''
+    row=lice_index['rows'].get(SEPA_ID)
+    if row is None:
+        logger.debug(f'{SEPA_ID} has no lice data in the lice dataset')
+        return np.full(len(lice_index['time']), np.nan, dtype='float32'), np.nan
+    return lice_index['lice'][row], lice_index['mean lice'][row]
     
-def prepare_zarr():
-    # zoom 10 = 38.218 m so if zoom > 9 50m zarr then image is max 512 px
-    # should we fix the width to 1024? zarr needs 256 chunks to go faster probably
-    # first zoom 5.5 so compute for zoom 5 to 9 (5 zarrs) 50(9) - 100 (8) - 200 (7) - 400(6) - 800 (5)
-    ds=xr.open_zarr('westcoast_map_trim.zarr/')#.chunk(chunks={'x':256,'y':256})
-    for (res, zoom) in zip([50,100,200,400,800],[9,8,7,6,5]):
-        ds= ds.coarsen(x=2,boundary='pad').mean().coarsen(y=2,boundary='pad').mean()#.chunk(chunks={'x':256,'y':256})
-        ds.to_zarr(f'map_{res}m.zarr')#, safe_chunks=False)
+def stack_farms(ds, names=None):
+    '''
+    Stack the per-farm variables of a dataset along a farm axis,
+    in the order of names (the farm_data IDs) when given
+    '''
+    if names is None:
+        names=list(ds.keys())
+    else:
+        missing=[farm for farm in ds.keys() if farm not in names]
+        if len(missing)>0:
+            logger.info(f'{len(missing)} farms are not in the farm list, appended at the end')
+        names=[farm for farm in names if farm in ds.keys()]+missing
+    logger.info(f'stacking {len(names)} farms')
+    cube=ds[names].to_array(dim='farm').transpose('farm', 'y', 'x')
+    return cube.assign_coords(ID=('farm', np.arange(len(names))))
+
+def cube_encoding(chunk=256, farm_chunk=32):
+    '''
+    float32 (farm, y, x) chunks compressed with zstd
+    '''
+    return {'density':{'dtype':'float32',
+                       'chunks':(farm_chunk, chunk, chunk),
+                       'compressor':Blosc(cname='zstd', clevel=3, shuffle=Blosc.BITSHUFFLE)}}
+
+def build_density_cube(src, dst, names=None, chunk=256, farm_chunk=32):
+    '''
+    Stack the per-farm variables of a density zarr into a single
+    (farm, y, x) float32 array written to dst.
+    names gives the farm order (the farm_data IDs), NaN padding is stored as 0
+    so that a render is one weighted reduction over the farm axis.
+    '''
+    logger.info(f'reading {src}')
+    cube=stack_farms(xr.open_zarr(src), names).fillna(0).astype('float32')
+    cube=cube.chunk({'farm':farm_chunk, 'y':chunk, 'x':chunk})
+    cube.to_dataset(name='density').to_zarr(dst, mode='w', consolidated=True,
+                                            encoding=cube_encoding(chunk, farm_chunk))
+    logger.info(f'cube written to {dst}')
     return
-    
-def search_lice_data(start,end, ident, farm, l_data, fdata, lice_time):
+
+def build_pyramid(src, rootdir, prefix='curr', base=25, resolutions=[50,100,200,400,800],
+                  names=None, chunk=256, farm_chunk=32):
+    '''
+    Build every level of the density pyramid from the source zarr at base
+    resolution (m) in one streaming pass: each level is the mean of the source
+    cells it covers, written as a float32 (farm, y, x) cube {prefix}_{r}m_cube.zarr
+    with chunk x chunk spatial tiles and consolidated metadata.
+    A manifest of the levels and their bounds is written to {prefix}_pyramid.json
+    and the land and border masks of each level to mask_{r}m.zarr.
+    '''
+    factors=[r//base for r in resolutions]
+    # source tiles aligned on the coarsest level
+    tile=max(factors)*int(np.ceil(chunk/max(factors)))
+    cube=stack_farms(xr.open_zarr(src), names).astype('float32')
+    cube=cube.chunk({'farm':farm_chunk, 'y':tile, 'x':tile})
+    writes=[]
+    manifest={'source':src, 'base resolution':base, 'farms':list(cube.farm.values), 'levels':[]}
+    for r, factor in zip(resolutions, factors):
+        level=cube.coarsen(x=factor, y=factor, boundary='pad').mean().fillna(0)
+        level=level.chunk({'farm':farm_chunk, 'y':chunk, 'x':chunk})
+        dst=f'{prefix}_{r}m_cube.zarr'
+        writes.append(level.to_dataset(name='density').to_zarr(rootdir+dst, mode='w', consolidated=True,
+                                                               compute=False, encoding=cube_encoding(chunk, farm_chunk)))
+        manifest['levels'].append({'resolution':r,
+                                   'path':dst,
+                                   'shape':[int(n) for n in level.shape],
+                                   'chunks':[farm_chunk, chunk, chunk],
+                                   'bounds':{'xmin':float(level.x.min()), 'xmax':float(level.x.max()),
+                                             'ymin':float(level.y.min()), 'ymax':float(level.y.max())}})
+    logger.info(f'writing {len(writes)} levels from {src}')
+    # one graph so the source chunks are read once for all the levels
+    dask.compute(*writes)
+    for r in resolutions:
+        build_masks(xr.open_zarr(rootdir+f'{prefix}_{r}m_cube.zarr'), rootdir+f'mask_{r}m.zarr')
+    with open(rootdir+f'{prefix}_pyramid.json', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    logger.info(f'pyramid written to {rootdir}')
+    return manifest
+
+# area removed from the density maps (EPSG:3857)
+land_polygon=[{"type":"Polygon",
+               "coordinates":[[
+                 [-890556, 7719350],
+                 [-829330, 7618370],
+                 [-857160, 7588335],
+                 [-912820, 7688916],
+                 [-890556, 7719350]
+               ]]
+             }]
+# the existing farms are cut east of this line (EPSG:3857)
+border_x=-509945
+
+def build_masks(grid, dst):
+    '''
+    Rasterise the land polygon and the border on the y, x grid of a level.
+    Both masks are True where the density is kept:
+    land outside of the polygon, border west of border_x (existing farms only)
+    '''
+    x, y = grid.x.values, grid.y.values
+    dx, dy = float(x[1]-x[0]), float(y[1]-y[0])
+    transform=Affine(dx, 0., float(x[0])-dx/2, 0., dy, float(y[0])-dy/2)
+    land=geometry_mask(land_polygon, out_shape=(len(y), len(x)), transform=transform)
+    border=np.broadcast_to(x<border_x, land.shape)
+    masks=xr.Dataset({'land':(('y','x'), land),
+                      'border':(('y','x'), border)},
+                     coords={'y':y, 'x':x})
+    masks.to_zarr(dst, mode='w', consolidated=True)
+    logger.info(f'masks written to {dst}')
+    return
+
+def build_all_masks(rootdir, resolutions=[50,100,200,400,800]):
+    '''
+    Build the masks of every resolution on the grid of the current farms
+    '''
+    for r in resolutions:
+        build_masks(xr.open_zarr(rootdir+f'curr_{r}m.zarr'), rootdir+f'mask_{r}m.zarr')
+    return
+
+def build_memmap_cube(src, dst, names=None, farm_chunk=32):
+    '''
+    Write the per-farm variables of a density zarr as a raw little-endian
+    float32 (farm, y, x) .npy file dst, NaN stored as 0, and its coordinates
+    to the json sidecar next to it. The farms are copied farm_chunk at a time.
+    '''
+    cube=stack_farms(xr.open_zarr(src), names)
+    data=np.lib.format.open_memmap(dst, mode='w+', dtype='<f4', shape=cube.shape)
+    for start in range(0, cube.sizes['farm'], farm_chunk):
+        data[start:start+farm_chunk]=np.nan_to_num(cube[start:start+farm_chunk].values)
+    data.flush()
+    sidecar={'farm':[str(farm) for farm in cube.farm.values],
+             'y':cube.y.values.tolist(),
+             'x':cube.x.values.tolist(),
+             'dtype':'<f4',
+             'shape':list(cube.shape),
+             'source':src}
+    with open(dst[:-len('.npy')]+'.json', 'w') as f:
+        json.dump(sidecar, f)
+    logger.info(f'memmap cube written to {dst}')
+    return
+
+def build_all_memmaps(rootdir, names=None, resolutions=[50,100,200,400,800]):
+    '''
+    Convert the current and planned density zarrs of every resolution
+    '''
+    for r in resolutions:
+        build_memmap_cube(rootdir+f'curr_{r}m.zarr', rootdir+f'curr_{r}m_cube.npy', names)
+        build_memmap_cube(rootdir+f'planned_{r}m.zarr', rootdir+f'planned_{r}m_cube.npy')
+    return
+
+def benchmark_loaders(rootdir, r, repeat=3):
+    '''
+    Time the opening of the current farms of a level and the sum of
+    all its farms with the zarr (as global_store did, with the pickle
+    of the Redis memoisation), the zarr cube and the memmap layouts
+    '''
+    import pickle
+    from time import perf_counter
+    from density import load_density_cube, load_memmap_cube, weighted_sum
+    def zarr_store():
+        ds=xr.open_zarr(rootdir+f'curr_{r}m.zarr')
+        ds=ds.where(ds.x<border_x)
+        return pickle.loads(pickle.dumps(ds))
+    def zarr_sum(ds):
+        return stack_farms(ds).fillna(0).sum('farm').compute()
+    loaders={'zarr':(zarr_store, zarr_sum),
+             'cube':(lambda: load_density_cube(rootdir+f'curr_{r}m_cube.zarr'),
+                     lambda cube: weighted_sum(cube, np.ones(cube.sizes['farm']), cube.farm.values).compute()),
+             'memmap':(lambda: load_memmap_cube(rootdir+f'curr_{r}m_cube.npy'),
+                       lambda cube: weighted_sum(cube, np.ones(cube.sizes['farm']), cube.farm.values))}
+    results={}
+    for name, (load, total) in loaders.items():
+        opening, summing = [], []
+        for _ in range(repeat):
+            start=perf_counter()
+            store=load()
+            opening.append(perf_counter()-start)
+            start=perf_counter()
+            total(store)
+            summing.append(perf_counter()-start)
+        results[name]={'open (ms)':min(opening)*1000, 'sum (ms)':min(summing)*1000}
+    return results
+
+def build_all_cubes(rootdir, names=None, resolutions=[50,100,200,400,800]):
+    '''
+    Build the dense cubes of the current and planned farms for every resolution
+    '''
+    for r in resolutions:
+        build_density_cube(rootdir+f'curr_{r}m.zarr', rootdir+f'curr_{r}m_cube.zarr', names)
+        build_density_cube(rootdir+f'planned_{r}m.zarr', rootdir+f'planned_{r}m_cube.zarr')
+    return
+
+def spectral_estimate(A, U, V, max_iter=50, rtol=1e-3, seed=0):
+    '''
+    Power iteration estimate of the largest singular value of A - U @ V,
+    iterated until it changes by less than rtol. It approaches the spectral
+    norm from below so it is the typical, not the worst, render error per |c|
+    '''
+    x=np.random.default_rng(seed).standard_normal(A.shape[1])
+    norm=0.
+    for _ in range(max_iter):
+        x/=np.linalg.norm(x)
+        y=(A@x).compute()-U@(V@x)
+        x=(A.T@y).compute()-V.T@(U.T@y)
+        previous, norm = norm, np.sqrt(np.linalg.norm(x))
+        if abs(norm-previous)<=rtol*norm:
+            break
+    return float(norm)
+
+def build_lowrank(src, dst, rank=64, n_power_iter=2, chunk=256):
+    '''
+    Factorise the (farm, cell) matrix of a density cube with a randomised SVD
+    truncated to rank components: cube ~ U @ V with U (farm, component)
+    scaled by the singular values and V (component, y, x).
+    The Frobenius norm of the residual is stored as 'error bound', it bounds
+    the error of any render: |c @ (A - U @ V)| <= |c| * error bound.
+    The relative Frobenius error and a power iteration estimate of the
+    spectral norm of the residual are stored with it.
+    '''
+    cube=xr.open_zarr(src)['density'].transpose('farm','y','x')
+    ny, nx = cube.sizes['y'], cube.sizes['x']
+    A=cube.data.rechunk({0:32, 1:max(1, 2**16//nx), 2:-1}).reshape(cube.sizes['farm'], ny*nx).astype('float64')
+    rank=min(rank, *A.shape)
+    logger.info(f'factorising {src} to rank {rank}')
+    u, sigma, v = dask.compute(*da.linalg.svd_compressed(A, k=rank, n_power_iter=n_power_iter, seed=0))
+    U, V = u*sigma, v
+    # the residual is computed, not derived from the singular values,
+    # so that rounding cannot make the bound too small
+    residual=A-da.from_array(U, chunks=(A.chunks[0], -1))@da.from_array(V, chunks=(-1, A.chunks[1]))
+    total, squares = [float(v) for v in dask.compute((A**2).sum(), (residual**2).sum())]
+    bound=np.sqrt(squares)
+    frobenius=float(bound/np.sqrt(total)) if total>0 else 0.
+    spectral=spectral_estimate(A, U, V)
+    lowrank=xr.Dataset({'U':(('farm','component'), U.astype('float32')),
+                        'V':(('component','y','x'), V.reshape(rank, ny, nx).astype('float32'))},
+                       coords={'farm':cube.farm.values, 'y':cube.y.values, 'x':cube.x.values},
+                       attrs={'rank':rank,
+                              'relative frobenius error':frobenius,
+                              'error bound':float(bound),
+                              'spectral estimate':spectral,
+                              'compression ratio':cube.sizes['farm']/rank})
+    lowrank.chunk({'component':rank, 'y':chunk, 'x':chunk}).to_zarr(dst, mode='w', consolidated=True)
+    logger.info(f'low-rank basis written to {dst}')
+    return lowrank.attrs
+
+def build_all_lowrank(rootdir, rank=64, resolutions=[50,100,200,400,800]):
+    '''
+    Factorise the cubes of the current and planned farms for every resolution
+    and report the reconstruction errors
+    '''
+    report={}
+    for r in resolutions:
+        for prefix in ['curr', 'planned']:
+            report[f'{prefix}_{r}m']=build_lowrank(rootdir+f'{prefix}_{r}m_cube.zarr', rootdir+f'{prefix}_{r}m_lowrank.zarr', rank)
+    return report
+
+def build_footprints(src, dst, names=None, cell_chunk=2**20):
+    '''
+    Store each farm of a density zarr as the bounding box of its non-empty cells.
+    The tiles are flattened and concatenated in values, each farm is located
+    by its offset in values and its bbox (y0, y1, x0, x1, half open) on the grid.
+    '''
+    ds=xr.open_zarr(src)
+    if names is None:
+        names=list(ds.keys())
+    else:
+        names=[farm for farm in names if farm in ds.keys()]
+    bbox=np.zeros((len(names),4), dtype='int64')
+    offset=np.zeros(len(names)+1, dtype='int64')
+    tiles=[]
+    for i, farm in enumerate(names):
+        arr=ds[farm].transpose('y','x').values
+        filled=np.isfinite(arr)&(arr!=0)
+        rows=np.nonzero(filled.any(axis=1))[0]
+        cols=np.nonzero(filled.any(axis=0))[0]
+        if len(rows)==0:
+            logger.info(f'{farm} has no data in {src}')
+        else:
+            bbox[i]=rows[0], rows[-1]+1, cols[0], cols[-1]+1
+            tiles.append(np.nan_to_num(arr[rows[0]:rows[-1]+1, cols[0]:cols[-1]+1]).astype('float32').ravel())
+        offset[i+1]=offset[i]+(bbox[i,1]-bbox[i,0])*(bbox[i,3]-bbox[i,2])
+    logger.info(f'{offset[-1]} cells kept out of {len(names)*ds.sizes["y"]*ds.sizes["x"]} in {src}')
+    values=np.concatenate(tiles) if len(tiles)>0 else np.zeros(0, dtype='float32')
+    fp=xr.Dataset({'values':('cell', values),
+                   'offset':('farm', offset[:-1]),
+                   'bbox':(('farm','corner'), bbox)},
+                  coords={'farm':names,
+                          'corner':['y0','y1','x0','x1'],
+                          'y':ds.y.values,
+                          'x':ds.x.values})
+    fp.chunk({'cell':cell_chunk}).to_zarr(dst, mode='w', consolidated=True)
+    logger.info(f'footprints written to {dst}')
+    return
+
+def build_all_footprints(rootdir, names=None, resolutions=[50,100,200,400,800]):
+    '''
+    Build the footprint stores of the current and planned farms for every resolution
+    '''
+    for r in resolutions:
+        build_footprints(rootdir+f'curr_{r}m.zarr', rootdir+f'curr_{r}m_sparse.zarr', names)
+        build_footprints(rootdir+f'planned_{r}m.zarr', rootdir+f'planned_{r}m_sparse.zarr')
+    return
+
+def search_lice_data(start,end, ident, lice_index):
     '''
     Search if there are data for the farm at the chosen date.
     Check it is not null
@@ -128,17 +481,17 @@ def search_lice_data(start,end, ident, farm, l_data, fdata, lice_time):
     if not, try to return the average lice value for the farm.
     '''
     logger.debug(f'searching lice data for {ident}')
-    t_filter= np.where(np.logical_and(lice_time> start, lice_time< end))[0]
-    # logger.debug(f'Data for {ident} are:    {l_data}')
-    may_data= np.array(l_data)[t_filter].mean()
+    l_data, mean_lice = add_lice_data(ident, lice_index)
+    t_filter= np.where(np.logical_and(lice_index['time']> start, lice_index['time']< end))[0]
+    may_data= l_data[t_filter].mean()
     if not np.isnan(may_data):
             if may_data>0:
                 logger.info(f'found may data for {ident}')
                 return may_data
     else:
-            if np.isnan(fdata['mean lice']) is False:
+            if not np.isnan(mean_lice):
                 logger.info(f'Used average for {ident}')
-                return fdata['mean lice']
+                return mean_lice
 
     
     
@@ -197,3 +550,64 @@ def initii():
 logging.basicConfig(format='%(levelname)s:%(asctime)s__%(message)s', datefmt='%m/%d/%Y %I:%M:%S')
 logger = logging.getLogger('sealice_logger')
 logger.setLevel(logging.DEBUG)
+
+if __name__ == '__main__':
+    import argparse
+    logging.basicConfig(format='%(levelname)s:%(asctime)s__%(message)s', datefmt='%m/%d/%Y %I:%M:%S')
+    parser=argparse.ArgumentParser(description='Preprocessing of the sealice density datasets')
+    commands=parser.add_subparsers(dest='command', required=True)
+    cube_parser=commands.add_parser('cube', help='stack the per-farm zarrs into (farm, y, x) cubes')
+    cube_parser.add_argument('rootdir', help='directory holding the curr_*m.zarr and planned_*m.zarr')
+    cube_parser.add_argument('--csv', default=None,
+                             help='biomass csv used to order the farms as the farm_data IDs')
+    sparse_parser=commands.add_parser('sparse', help='store the per-farm zarrs as bounding-box footprints')
+    sparse_parser.add_argument('rootdir', help='directory holding the curr_*m.zarr and planned_*m.zarr')
+    sparse_parser.add_argument('--csv', default=None,
+                             help='biomass csv used to order the farms as the farm_data IDs')
+    pyramid_parser=commands.add_parser('pyramid', help='build all the levels of the density cubes from the base zarr')
+    pyramid_parser.add_argument('src', help='per-farm density zarr at the base resolution')
+    pyramid_parser.add_argument('rootdir', help='output directory')
+    pyramid_parser.add_argument('--prefix', default='curr', help='curr or planned')
+    pyramid_parser.add_argument('--base', type=int, default=25, help='resolution of the source (m)')
+    pyramid_parser.add_argument('--csv', default=None,
+                             help='biomass csv used to order the farms as the farm_data IDs')
+    mask_parser=commands.add_parser('mask', help='rasterise the land and border masks of every resolution')
+    mask_parser.add_argument('rootdir', help='directory holding the curr_*m.zarr')
+    lowrank_parser=commands.add_parser('lowrank', help='factorise the cubes into a truncated basis')
+    lowrank_parser.add_argument('rootdir', help='directory holding the curr_*m_cube.zarr and planned_*m_cube.zarr')
+    lowrank_parser.add_argument('--rank', type=int, default=64, help='number of components kept')
+    lowrank_parser.add_argument('--resolutions', type=int, nargs='+', default=[50,100,200,400,800])
+    memmap_parser=commands.add_parser('memmap', help='convert the per-farm zarrs into memory-mappable .npy cubes')
+    memmap_parser.add_argument('rootdir', help='directory holding the curr_*m.zarr and planned_*m.zarr')
+    memmap_parser.add_argument('--csv', default=None,
+                             help='biomass csv used to order the farms as the farm_data IDs')
+    bench_parser=commands.add_parser('bench', help='compare the loading of a level from the zarr, cube and memmap stores')
+    bench_parser.add_argument('rootdir', help='directory holding the converted stores')
+    bench_parser.add_argument('--resolution', type=int, default=800)
+    args=parser.parse_args()
+    logger.setLevel(logging.INFO)
+    names=None
+    if getattr(args, 'csv', None) is not None:
+        ds_path=args.src if args.command=='pyramid' else args.rootdir+'curr_800m.zarr'
+        ds_names=list(xr.open_zarr(ds_path).keys())
+        names=list(read_farm_table(args.csv, ds_names)[0]['name'])
+    if args.command=='pyramid':
+        build_pyramid(args.src, args.rootdir, args.prefix, args.base, names=names)
+    elif args.command=='cube':
+        build_all_cubes(args.rootdir, names)
+    elif args.command=='sparse':
+        build_all_footprints(args.rootdir, names)
+    elif args.command=='memmap':
+        build_all_memmaps(args.rootdir, names)
+    elif args.command=='bench':
+        print(f"{'store':<8}{'open (ms)':>12}{'sum (ms)':>12}")
+        for name, result in benchmark_loaders(args.rootdir, args.resolution).items():
+            print(f"{name:<8}{result['open (ms)']:>12.1f}{result['sum (ms)']:>12.1f}")
+    elif args.command=='mask':
+        build_all_masks(args.rootdir)
+    elif args.command=='lowrank':
+        report=build_all_lowrank(args.rootdir, args.rank, args.resolutions)
+        print(f"{'cube':<16}{'rank':>6}{'ratio':>8}{'frobenius':>12}{'bound':>12}{'spectral':>12}")
+        for name, attrs in report.items():
+            print(f"{name:<16}{attrs['rank']:>6}{attrs['compression ratio']:>8.1f}"
+                  f"{attrs['relative frobenius error']:>12.2e}{attrs['error bound']:>12.2e}{attrs['spectral estimate']:>12.2e}")
@@ -0,0 +1,142 @@
+# This file is part of sealice visualisation tools.
+#
+# This app is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3
+#
+# The app is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details., see
+# <https://www.gnu.org/licenses/>.
+#
+# Copyright 2022, Julien Moreau, Plastic@Bay CIC
+
+import hashlib, logging
+from os import path
+import numpy as np
+import xarray as xr
+
+from preprocess import read_farm_table, read_future_farms, read_SEPA_GSID, index_lice_data
+from scenario import year_table
+
+logger = logging.getLogger('sealice_logger')
+
+master='curr_800m.zarr'
+futurefile='farm_data/future_farms.txt'
+liceStore='farm_data/consolidated_sealice_data_2017-2021.zarr'
+csvfile='farm_data/biomasses_to_03-2023.csv'
+sepacsv='farm_data/SEPA_GSID.csv'
+# years of the year slider
+years=range(2004, 2024)
+
+# one registry per data directory and per process
+_registries={}
+
+def xr_opening(path):
+    try:
+        logger.info(f'{path} is valid')
+        return xr.open_zarr(path)
+    except:
+        logger.error(f'could not open {path}')
+        return xr.Dataset() #dummy
+
+def registry_version(rootdir):
+    '''
+    Key identifying the version of the reference data files
+    '''
+    stamp=[]
+    for f in [master, futurefile, liceStore, csvfile, sepacsv]:
+        if path.exists(rootdir+f):
+            stamp.append(f'{f}:{path.getmtime(rootdir+f)}')
+    return hashlib.sha1('|'.join(stamp).encode()).hexdigest()[:12]
+
+def freeze(obj):
+    '''
+    Make the arrays of the registry read only
+    '''
+    if isinstance(obj, np.ndarray):
+        obj.flags.writeable=False
+    elif isinstance(obj, dict):
+        for value in obj.values():
+            freeze(value)
+    return obj
+
+# columns of the farm registry, one row per farm in the order of the farm IDs
+farm_fields=[('name', 'U100'),
+             ('ID', 'i8'),
+             ('lat', 'f8'),
+             ('lon', 'f8'),
+             ('licensed peak biomass', 'f8'),
+             ('max biomass', 'f8'),
+             ('mean lice', 'f8'),
+             ('Site ID Scot env', 'U20'),
+             ('Site ID SEPA', 'U20'),
+             ('GSID', 'U20'),
+             ('Name MS', 'U100'),
+             ('operator', 'U100'),
+             ('Prod year', 'U20'),
+             ('additional location', 'U100'),
+             ('production cycle', 'U20'),
+             ('production in 3 years 2021', 'U20'),
+             ]
+
+def farm_columns(table, lice_index, gsid):
+    '''
+    Build aligned columns from the farm table of read_farm_table:
+    a structured array of the farm attributes, the (farm, time) biomass
+    matrix, the (farm, lice time) lice matrix and the name to ID map.
+    The lice of each farm are gathered from the lice index.
+    '''
+    farms=np.zeros(len(table['name']), dtype=farm_fields)
+    for field, _ in farm_fields:
+        if field in table:
+            farms[field]=table[field]
+    farms['GSID']=[gsid.get(farm, '') for farm in table['name']]
+    rows=np.array([lice_index['rows'].get(ident, -1) for ident in table['Site ID Scot env']], dtype='int64')
+    found=rows>=0
+    logger.debug(f'{(~found).sum()} farms without lice records')
+    lice=np.full((len(farms), len(lice_index['time'])), np.nan, dtype='float32')
+    lice[found]=lice_index['lice'][rows[found]]
+    farms['mean lice']=np.nan
+    farms['mean lice'][found]=lice_index['mean lice'][rows[found]]
+    index={farm:i for i, farm in enumerate(farms['name'])}
+    return farms, table['biomass'], lice, index
+
+def farm_record(variables, name):
+    '''
+    Attributes of one farm as a dictionary
+    '''
+    row=variables['farms'][variables['farm index'][name]]
+    return {field:row[field].item() for field, _ in farm_fields}
+
+def read_reference_data(rootdir):
+    '''
+    Read the farm, biomass, lice and planned farm data
+    '''
+    logger.info('Preparing dataset')
+    variables={}
+    super_ds=xr_opening(rootdir+master)#.drop('North Kilbrannan')
+    variables['All_names']=np.array(list(super_ds.keys()))
+    variables['future_farms']=read_future_farms(rootdir+futurefile)
+    lice_index=index_lice_data(xr_opening(rootdir+liceStore))
+    variables['lice time']=lice_index['time']
+    table, variables['times'] =read_farm_table(rootdir+csvfile, super_ds.keys())
+    logger.info('Farm loaded')
+    variables['farms'], variables['biomass'], variables['lice'], variables['farm index'] = farm_columns(table, lice_index,
+                                                                                      read_SEPA_GSID(rootdir+sepacsv))
+    variables['year table']=year_table(variables['farms'], variables['biomass'], variables['lice'],
+                                       variables['times'], variables['lice time'], years)
+    variables['version']=registry_version(rootdir)
+    logger.info('Variables loaded')
+    return freeze(variables)
+
+def load_registry(rootdir):
+    '''
+    Reference data of the app, read once per process and shared read only
+    by all the callbacks instead of going through the browser.
+    The farms are held in columns (farms, biomass, lice, farm index).
+    '''
+    if rootdir not in _registries:
+        _registries[rootdir]=read_reference_data(rootdir)
+    return _registries[rootdir]
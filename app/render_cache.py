@@ -0,0 +1,109 @@
+# This file is part of sealice visualisation tools.
+#
+# This app is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3
+#
+# The app is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details., see
+# <https://www.gnu.org/licenses/>.
+#
+# Copyright 2022, Julien Moreau, Plastic@Bay CIC
+
+import json, logging
+from time import time
+
+logger = logging.getLogger('sealice_logger')
+
+def parse_size(size):
+    '''
+    Number of bytes of a size given as an int or a string such as 512mb
+    '''
+    size=str(size).strip().lower()
+    for unit, factor in [('gb', 2**30), ('mb', 2**20), ('kb', 2**10), ('b', 1)]:
+        if size.endswith(unit):
+            return int(float(size[:-len(unit)])*factor)
+    return int(size)
+
+class RenderCache:
+    '''
+    Content-addressed cache of the rendered density images in Redis.
+    An entry holds the png bytes and the corner coordinates of the image,
+    it expires after ttl seconds. If maxmemory (bytes, or e.g. '512mb') is given
+    the least recently used images are evicted to keep their total size under
+    that budget. Only the keys of the cache are evicted, the configuration of
+    the Redis server, shared with the other caches and Celery, is left alone.
+    '''
+    def __init__(self, client, prefix='render', ttl=24*3600, maxmemory=None):
+        self.client=client
+        self.prefix=prefix
+        self.ttl=ttl
+        self.maxmemory=parse_size(maxmemory) if maxmemory is not None else None
+        if self.maxmemory is not None:
+            logger.info(f'render cache budget set to {maxmemory}')
+
+    def get(self, key, count=True):
+        '''
+        Return (png, coordinates) or None and count the hit or miss
+        '''
+        entry=self.client.hgetall(f'{self.prefix}:{key}')
+        if not entry:
+            if count:
+                self.client.incr(f'{self.prefix}:misses')
+            return None
+        if count:
+            self.client.incr(f'{self.prefix}:hits')
+        if self.maxmemory is not None:
+            self.client.zadd(f'{self.prefix}:lru', {key:time()})
+        return entry[b'png'], json.loads(entry[b'coordinates'])
+
+    def set(self, key, png, coordinates):
+        name=f'{self.prefix}:{key}'
+        pipe=self.client.pipeline()
+        pipe.hset(name, mapping={'png':png, 'coordinates':json.dumps(coordinates)})
+        pipe.expire(name, self.ttl)
+        if self.maxmemory is not None:
+            size=len(png)+len(json.dumps(coordinates))
+            pipe.zadd(f'{self.prefix}:lru', {key:time()})
+            pipe.hset(f'{self.prefix}:sizes', key, size)
+            pipe.incrby(f'{self.prefix}:bytes', size)
+        pipe.execute()
+        if self.maxmemory is not None:
+            self.evict()
+
+    def evict(self):
+        '''
+        Remove the least recently used images until the cache fits in maxmemory,
+        the entries that expired are the oldest and go first
+        '''
+        while int(self.client.get(f'{self.prefix}:bytes') or 0)>self.maxmemory:
+            oldest=self.client.zpopmin(f'{self.prefix}:lru')
+            if not oldest:
+                self.client.set(f'{self.prefix}:bytes', 0)
+                break
+            key=oldest[0][0].decode()
+            size=int(self.client.hget(f'{self.prefix}:sizes', key) or 0)
+            pipe=self.client.pipeline()
+            pipe.delete(f'{self.prefix}:{key}')
+            pipe.hdel(f'{self.prefix}:sizes', key)
+            pipe.decrby(f'{self.prefix}:bytes', size)
+            pipe.execute()
+
+    def lock(self, key, timeout=120):
+        '''
+        Redis lock held while the image of key is rendered so that
+        identical renders in flight wait for the first one
+        '''
+        return self.client.lock(f'{self.prefix}:lock:{key}', timeout=timeout, blocking_timeout=timeout)
+
+    def stats(self):
+        '''
+        Hit and miss counters of the cache
+        '''
+        hits, misses = [int(v or 0) for v in self.client.mget(f'{self.prefix}:hits', f'{self.prefix}:misses')]
+        total=hits+misses
+        return {'hits':hits,
+                'misses':misses,
+                'hit ratio':hits/total if total>0 else None}
@@ -0,0 +1,141 @@
+# This file is part of sealice visualisation tools.
+#
+# This app is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3
+#
+# The app is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details., see
+# <https://www.gnu.org/licenses/>.
+#
+# Copyright 2022, Julien Moreau, Plastic@Bay CIC
+
+import logging, warnings
+import numpy as np
+from datetime import datetime
+
+logger = logging.getLogger('sealice_logger')
+
+def may_window(year):
+    '''
+    Bounds (excluded) of the month of May of the year
+    '''
+    return np.datetime64(datetime(year=year, month=4,day=30),'D'), np.datetime64(datetime(year=year, month=6,day=1),'D')
+
+def fetch_biomass(farms, biomass, lice, times, lice_time, lice_factor, flag, year=2018):
+    '''
+    Identify the biomass data for the month of may of the chosen year
+    scale the data according to data
+    remove farm with no data for the month
+    if flag is true (toggle is on) try to populate the lice density for each farm
+    with the may data, or the farm average, or 0.5 lice per fish.
+    All farms are processed at once on the (farm, time) biomass
+    and (farm, lice time) lice matrices.
+    '''
+    start, end = may_window(year)
+    window=(times>start) & (times<end)
+    may=biomass[:,window]
+    with warnings.catch_warnings():
+        # farms without any biomass in May give empty means
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        extract=np.nanmean(np.where(may!=0, may, np.nan), axis=1)
+    activated_farms=~np.isnan(extract)
+    biomass_factor=np.where(activated_farms, extract/farms['max biomass'], 0)
+    ref_biom=np.where(activated_farms, farms['max biomass'], 0)
+    lice_factor=np.array(lice_factor, dtype='float64')
+    if flag:
+        lice_window=(lice_time>start) & (lice_time<end)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            may_lice=lice[:,lice_window].mean(axis=1)
+        mean_lice=np.where(np.isnan(farms['mean lice']), 0.5, farms['mean lice'])
+        measured=np.where(np.isnan(may_lice), mean_lice, np.where(may_lice>0, may_lice, 0.5))
+        measured[farms['Site ID Scot env']=='']=0.5
+        logger.debug(f'{np.isnan(may_lice).sum()} farms without lice data in May {year}')
+        lice_factor=np.where(activated_farms, measured, lice_factor)
+    return activated_farms, biomass_factor, lice_factor, ref_biom
+
+def year_table(farms, biomass, lice, times, lice_time, years):
+    '''
+    Precompute for each year the farm activation flags, the May biomass factors,
+    the reference biomass and the measured (or extrapolated) lice factors
+    '''
+    table={}
+    no_lice=np.full(len(farms), np.nan)
+    for year in years:
+        active, biomass_factor, measured, ref_biom = fetch_biomass(farms, biomass, lice, times, lice_time,
+                                                                   no_lice, True, year)
+        table[year]={'active':active,
+                     'biomass factor':biomass_factor,
+                     'reference biomass':ref_biom,
+                     'measured lice':measured}
+    logger.info(f'scenario table built for {len(table)} years')
+    return table
+
+def scenario_factors(table, year, lice_factor, flag):
+    '''
+    Same outputs as fetch_biomass read from the year table,
+    lice_factor is used unless flag asks for the measured lice
+    '''
+    row=table[year]
+    if flag:
+        lice_factor=np.where(row['active'], row['measured lice'], lice_factor)
+    return row['active'], row['biomass factor'], np.array(lice_factor, dtype='float64'), row['reference biomass']
+
+def lice_factors(n, lice_knob, egg, measured):
+    '''
+    Lice factor of the n farms from the lice knob and the egg model,
+    Stein (30) if egg is on, Rittenhouse (16.9) otherwise.
+    The knob is ignored (per farm measured lice) if measured is on.
+    '''
+    c_lice=30/16.9 if egg else 1
+    lice_factor=np.ones(n)
+    if not measured:
+        lice_knob *=2
+        if lice_knob==0:
+            lice_knob=0.00001
+        lice_factor*=lice_knob
+    lice_factor *= c_lice
+    return {'lice factor': lice_factor,
+            'lice knob': lice_knob,
+            'egg factor': c_lice}
+
+def scenario_coefficients(variables, year, biomass_knob, lice, biomass_toggle, measured):
+    '''
+    Active farms of the year and their density coefficients:
+    global biomass knob (%) x individual farm biomass x individual lice x egg model.
+    lice holds the output of lice_factors.
+    The coefficients are the product of a global factor (the knobs) and
+    unit coefficients that only depend on the year and the toggles,
+    so that a knob change only rescales the density map.
+    '''
+    lice_factor=np.array(lice['lice factor'])
+    if biomass_knob ==0:
+        biomass_knob=0.00001
+    biomass_knob /=100
+    farms=variables['farms']
+    if year in variables['year table']:
+        idx, biomass_factor, lice_factor, ref_biom=scenario_factors(variables['year table'], year, lice_factor, measured)
+    else:
+        idx, biomass_factor, lice_factor, ref_biom=fetch_biomass(farms, variables['biomass'], variables['lice'],
+                                                     variables['times'], variables['lice time'],
+                                                     lice_factor, measured, year)
+    if not biomass_toggle:
+        biomass_factor=np.ones(len(farms))
+    # the lice knob and egg model are uniform unless the lice are measured
+    lice_scale=1 if measured else lice['lice knob']*lice['egg factor']
+    global_factor=biomass_knob*lice_scale
+    unit_coeff=biomass_factor[idx]*lice_factor[idx]/lice_scale
+    coeff=global_factor*unit_coeff
+    return {'coeff': coeff,
+            'unit coeff': unit_coeff,
+            'global factor': global_factor,
+            'all lice': (coeff*ref_biom[idx]).sum()*1000*0.5*16.7/4.5, #running in circles... running parameters
+            'name list': farms['name'][idx],
+            'current biomass': farms['licensed peak biomass'][idx]*biomass_factor[idx]*biomass_knob,
+            'year': year,
+            'biomass knob': biomass_knob,
+            'lice/egg factor': lice['lice knob']*lice['egg factor'],
+            }